@@ -0,0 +1,504 @@
+#! /usr/bin/env python3
+"""
+Benchmarks of appliance generation, run offline against an in-process fake docker engine and local
+git repositories, with synthetic app metadata.
+
+Results are written to ``benchmarks/results/<commit>.json``, and can be compared with results of
+another commit with ``--compare``.
+"""
+import argparse
+import contextlib
+import datetime
+import hashlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join as pjoin
+
+import docker
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+import make_appliance as ma  # noqa: E402
+
+RESULTS_PATH = pjoin(REPO_ROOT, 'benchmarks', 'results')
+APP_COUNTS = [10, 100]
+PARAM_COUNTS = [10, 100, 500]
+ARCHIVE_FILES = 1_000_000
+# files per directory in the synthetic archive
+ARCHIVE_FANOUT = 1000
+
+
+class FakeImage:
+    def __init__(self, image_id, tags, labels):
+        self.id = image_id
+        self.tags = tags
+        self.labels = labels
+
+
+class FakeImages:
+    def __init__(self):
+        self.images = {}
+        self.lock = threading.Lock()
+
+    def add(self, tag, labels):
+        with self.lock:
+            image_id = f'sha256:{hashlib.sha256(f"{tag}:{len(self.images)}:{time.time()}".encode()).hexdigest()}'
+            image = FakeImage(image_id, [f'{tag}:latest'], labels or {})
+            self.images[image_id] = image
+            self.images[tag] = image
+            return image
+
+    def get(self, name):
+        try:
+            return self.images[name.split(':latest')[0]]
+        except KeyError:
+            raise docker.errors.ImageNotFound(name)
+
+    def list(self, name=None):
+        if name is None:
+            return list({image.id: image for image in self.images.values()}.values())
+        return [self.images[name]] if name in self.images else []
+
+
+class FakeAPIClient:
+    def __init__(self, images):
+        self.images = images
+
+    def build(self, tag, decode=True, path=None, fileobj=None, dockerfile='Dockerfile', labels=None, **kwargs):
+        instructions = []
+        if path is not None:
+            with open(pjoin(path, dockerfile)) as dockerfile_file:
+                instructions = [line.strip() for line in dockerfile_file if line.strip() and not line.startswith('#')]
+        for i, instruction in enumerate(instructions, 1):
+            yield {'stream': f'Step {i}/{len(instructions)} : {instruction}\n'}
+        yield {'aux': {'ID': self.images.add(tag, labels).id}}
+
+
+class MetadataHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(self.server.appmetadata).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeContainer:
+    """
+    Serves synthetic app metadata on a free local port, as an app container would on its published port.
+    """
+    def __init__(self, image, port, appmetadata):
+        self.status = 'running'
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MetadataHandler)
+        self.server.appmetadata = appmetadata
+        self.ports = {port: [{'HostIp': '127.0.0.1', 'HostPort': str(self.server.server_port)}]}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reload(self):
+        pass
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.status = 'exited'
+
+
+class FakeContainers:
+    def __init__(self, images, n_params):
+        self.images = images
+        self.n_params = n_params
+
+    def run(self, image, ports=None, **kwargs):
+        app_name = self.images.get(image).tags[0].split(':')[0]
+        return FakeContainer(image, next(iter(ports)), gen_appmetadata(app_name, self.n_params))
+
+
+class FakeVolumes:
+    def __init__(self):
+        self.volumes = set()
+
+    def get(self, name):
+        if name not in self.volumes:
+            raise docker.errors.NotFound(name)
+        return name
+
+    def create(self, name):
+        self.volumes.add(name)
+        return name
+
+
+class FakeDockerClient:
+    """
+    Implements the part of ``docker.DockerClient`` that the appliance maker uses, without a docker daemon.
+    Builds are instant, and containers serve metadata of ``n_params`` parameters.
+    """
+    def __init__(self, n_params=10):
+        self.images = FakeImages()
+        self.api = FakeAPIClient(self.images)
+        self.containers = FakeContainers(self.images, n_params)
+        self.volumes = FakeVolumes()
+
+    def info(self):
+        return {'NCPU': 16, 'MemTotal': 64 * 1024 ** 3}
+
+
+def gen_appmetadata(app_name, n_params):
+    types = ['integer', 'number', 'string', 'boolean']
+    parameters = []
+    for i in range(n_params):
+        parameter = {'name': f'param{i}', 'type': types[i % len(types)], 'description': f'Synthetic parameter #{i} of {app_name}'}
+        if parameter['type'] == 'string' and i % 8 == 2:
+            parameter['choices'] = [f'choice{j}' for j in range(5)]
+        parameter['default'] = {'integer': i, 'number': i / 10, 'string': f'value{i}', 'boolean': 'true'}[parameter['type']]
+        parameters.append(parameter)
+    return {
+        'name': app_name,
+        'identifier': f'http://apps.clams.ai/{app_name}/v1.0',
+        'app_version': 'v1.0',
+        'description': f'Synthetic app {app_name}',
+        'license': 'MIT',
+        'input': [{'@type': 'http://mmif.clams.ai/0.4.0/vocabulary/AudioDocument', 'required': True},
+                  {'@type': 'http://mmif.clams.ai/0.4.0/vocabulary/TextDocument', 'required': False}],
+        'output': [{'@type': 'http://mmif.clams.ai/0.4.0/vocabulary/TimeFrame'}],
+        'parameters': parameters,
+    }
+
+
+def git(*args, cwd=None):
+    subprocess.run(['git', *args], cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def make_git_repo(path, files):
+    os.makedirs(path)
+    for f_name, content in files.items():
+        os.makedirs(os.path.dirname(pjoin(path, f_name)), exist_ok=True)
+        with open(pjoin(path, f_name), 'w') as f:
+            f.write(content)
+    git('init', '--quiet', cwd=path)
+    git('add', '.', cwd=path)
+    git('-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '--quiet', '-m', 'init', cwd=path)
+    return f'file://{path}'
+
+
+def make_galaxy_repo(path):
+    return make_git_repo(path, {
+        'Dockerfile': 'FROM bgruening/galaxy-stable:20.09\nCOPY config /etc/galaxy/\nCOPY tools /galaxy-central/tools/clams\n'
+                      'COPY display_applications /galaxy-central/display_applications/clams\nCOPY tool-data /galaxy-central/tool-data\n',
+        'config/tool_conf.xml': '<?xml version="1.0"?>\n<toolbox monitor="true">\n  <section id="getext" name="Get Data">\n'
+                                '    <tool file="data_source/upload.xml" />\n  </section>\n</toolbox>\n',
+        'config/datatypes_conf.xml': '<?xml version="1.0"?>\n<datatypes>\n  <registration converters_path="lib/galaxy/datatypes/converters">\n'
+                                     '    <datatype extension="json" type="galaxy.datatypes.text:Json" display_in_upload="true" />\n'
+                                     '  </registration>\n</datatypes>\n',
+        'tools/.keep': '',
+        'display_applications/.keep': '',
+        'tool-data/.keep': '',
+    })
+
+
+def make_app_repos(repos_path, n_apps):
+    apps_config = {}
+    for i in range(n_apps):
+        app_name = f'bench{i:03d}'
+        apps_config[app_name] = {
+            'enabled': True,
+            'repository': make_git_repo(pjoin(repos_path, app_name), {
+                'Dockerfile': 'FROM python:3.8-slim\nCOPY . /app\nWORKDIR /app\nCMD ["python", "app.py"]\n',
+                'app.py': f'# synthetic app {app_name}\n',
+            }),
+            'description': f'Synthetic app {app_name}',
+        }
+    return apps_config
+
+
+def make_archive(archive_path, n_files):
+    audio_path = pjoin(archive_path, 'audio')
+    for i in range(0, n_files, ARCHIVE_FANOUT):
+        dir_path = pjoin(audio_path, f'{i // ARCHIVE_FANOUT:05d}')
+        os.makedirs(dir_path)
+        for j in range(i, min(i + ARCHIVE_FANOUT, n_files)):
+            open(pjoin(dir_path, f'{j:07d}.wav'), 'w').close()
+    return audio_path
+
+
+def timed(func, *args, repeat=1):
+    """
+    Returns the best wall-clock time of ``repeat`` calls in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+@contextlib.contextmanager
+def workdir(base_path, name):
+    """
+    Changes into a fresh working directory, as the appliance maker works on relative paths.
+    """
+    path = pjoin(base_path, name)
+    os.makedirs(path)
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(cwd)
+
+
+def run_apps(apps_config, jobs):
+    tool_conf_path = pjoin(ma.GALAXY_LOCAL_PATH, 'config', 'tool_conf.xml')
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        app_pipelines = ma.submit_app_pipelines(pool, apps_config)
+        ma.process_all_apps(apps_config, ma.create_base_compose_obj(), '/archive', app_pipelines)
+    return tool_conf_path
+
+
+def bench_process_all_apps(base_path, repos_path, n_apps, n_params, jobs):
+    """
+    Clone, build, probe, and generate XMLs for ``n_apps`` apps, from scratch (cold) and again with
+    local copies and all caches (build manifest, appmetadata) in place (warm).
+    """
+    apps_config = make_app_repos(pjoin(repos_path, f'apps{n_apps}'), n_apps)
+    ma.init_docker_engine(FakeDockerClient(n_params))
+    with workdir(base_path, f'apps{n_apps}'):
+        with contextlib.redirect_stdout(io.StringIO()):
+            ma.download_galaxy_mods()
+        cold = timed(run_apps, apps_config, jobs)
+        warm = timed(run_apps, apps_config, jobs)
+    return {f'process_all_apps/{n_apps}apps/cold': cold, f'process_all_apps/{n_apps}apps/warm': warm}
+
+
+def bench_appmetadata_to_config_xml_tree(n_params, repeat):
+    appmetadata = gen_appmetadata('bench', n_params)
+    return {f'appmetadata_to_config_xml_tree/{n_params}params': timed(ma.appmetadata_to_config_xml_tree, appmetadata, repeat=repeat)}
+
+
+def bench_gen_app_config_xml(base_path, n_params, repeat):
+    """
+    Generate and write the tool XML of an app with ``n_params`` parameters, from scratch (first) and
+    with the same content already on disk (unchanged).
+    """
+    appmetadata = gen_appmetadata('bench', n_params)
+
+    def gen():
+        ma.gen_app_config_xml(f'{ma.APP_PREFIX}bench', ma.appmetadata_to_config_xml_tree(appmetadata), 5000)
+    with workdir(base_path, f'tool-xml{n_params}'):
+        os.makedirs(pjoin(ma.GALAXY_LOCAL_PATH, 'tools'))
+        first = timed(gen)
+        unchanged = timed(gen, repeat=repeat)
+    return {f'gen_app_config_xml/{n_params}params/first': first,
+            f'gen_app_config_xml/{n_params}params/unchanged': unchanged}
+
+
+def bench_add_to_tool_conf_xml(n_apps, repeat):
+    config_xml_trees = [(f'{ma.APP_PREFIX}bench{i:03d}', ma.appmetadata_to_config_xml_tree(gen_appmetadata(f'bench{i:03d}', 0)))
+                        for i in range(n_apps)]
+
+    def add_all():
+        tool_conf_tree = ET.ElementTree(ET.fromstring('<toolbox><section id="getext" name="Get Data"/></toolbox>'))
+        # indexed once, as in `process_all_apps`
+        sections, tool_sections = ma.index_tool_conf_sections(tool_conf_tree)
+        for app_name, config_xml_tree in config_xml_trees:
+            ma.add_to_tool_conf_xml(tool_conf_tree, config_xml_tree, app_name, sections, tool_sections)
+        # re-running updates existing entries
+        for app_name, config_xml_tree in config_xml_trees:
+            ma.add_to_tool_conf_xml(tool_conf_tree, config_xml_tree, app_name, sections, tool_sections)
+    return {f'add_to_tool_conf_xml/{n_apps}apps': timed(add_all, repeat=repeat)}
+
+
+def bench_gen_db_loc_files(base_path, n_files):
+    """
+    Index and list an archive of ``n_files`` files from scratch (cold), unchanged (warm),
+    and after adding a file to one directory (incremental).
+    """
+    archive_path = pjoin(base_path, 'archive')
+    audio_path = make_archive(archive_path, n_files)
+    # directories modified within the last couple of seconds are always listed again
+    time.sleep(3)
+    with workdir(base_path, 'archive-index'):
+        os.makedirs(pjoin(ma.GALAXY_LOCAL_PATH, 'tool-data'))
+        cold = timed(ma.gen_db_loc_files, archive_path)
+        warm = timed(ma.gen_db_loc_files, archive_path)
+        open(pjoin(audio_path, '00000', 'new.wav'), 'w').close()
+        incremental = timed(ma.gen_db_loc_files, archive_path)
+    return {f'gen_db_loc_files/{n_files}files/cold': cold,
+            f'gen_db_loc_files/{n_files}files/warm': warm,
+            f'gen_db_loc_files/{n_files}files/incremental': incremental}
+
+
+def check_archive_index(base_path):
+    """
+    Checks that the incremental archive index agrees with a full listing after files are added, removed,
+    and renamed, and that only changed directories are listed again. Raises AssertionError otherwise.
+    """
+    root = pjoin(base_path, 'check-archive')
+    for rel_dir in ('a', 'a/nested', 'b', 'c'):
+        os.makedirs(pjoin(root, rel_dir))
+    for rel_path in ('a/1.wav', 'a/nested/2.wav', 'b/3.wav', 'c/4.wav', 'c/.hidden.wav'):
+        open(pjoin(root, rel_path), 'w').close()
+
+    def age_dirs():
+        # as if the last change was long ago, so that unchanged directories are trusted
+        past = time.time() - 3600
+        for dir_path, _, _ in os.walk(root):
+            os.utime(dir_path, (past, past))
+
+    def full_listing():
+        return sorted(os.path.relpath(pjoin(dir_path, f_name), root).replace(os.sep, '/')
+                      for dir_path, _, f_names in os.walk(root) for f_name in f_names if not f_name.startswith('.'))
+
+    index_path = pjoin(base_path, 'check-archive-index.json')
+    age_dirs()
+    index = ma.update_archive_index(root, index_path)
+    assert sorted(ma.iter_archive_index(index)) == full_listing()
+    open(pjoin(root, 'a', 'nested', 'added.wav'), 'w').close()
+    os.remove(pjoin(root, 'b', '3.wav'))
+    os.rename(pjoin(root, 'c', '4.wav'), pjoin(root, 'c', 'renamed.wav'))
+    os.rename(pjoin(root, 'a', '1.wav'), pjoin(root, 'b', 'moved.wav'))
+    os.makedirs(pjoin(root, 'd'))
+    open(pjoin(root, 'd', '5.wav'), 'w').close()
+    age_dirs()
+    listed = []
+    scan_archive_dir = ma.scan_archive_dir
+    ma.scan_archive_dir = lambda dir_path: listed.append(os.path.relpath(dir_path, root)) or scan_archive_dir(dir_path)
+    try:
+        index = ma.update_archive_index(root, index_path)
+        assert sorted(ma.iter_archive_index(index)) == full_listing(), sorted(ma.iter_archive_index(index))
+        # only the directory with a new file is listed again
+        listed.clear()
+        open(pjoin(root, 'c', 'late.wav'), 'w').close()
+        os.utime(pjoin(root, 'c'), (time.time() - 1800, time.time() - 1800))
+        index = ma.update_archive_index(root, index_path)
+        assert sorted(ma.iter_archive_index(index)) == full_listing()
+        assert listed == ['c'], listed
+    finally:
+        ma.scan_archive_dir = scan_archive_dir
+
+
+def get_commit():
+    proc = subprocess.run(['git', '-C', REPO_ROOT, 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, universal_newlines=True)
+    commit = proc.stdout.strip() or 'unknown'
+    dirty = subprocess.run(['git', '-C', REPO_ROOT, 'diff', '--quiet', 'HEAD', '--', '*.py']).returncode != 0
+    return f'{commit}-dirty' if dirty else commit
+
+
+def run_benchmarks(app_counts, param_counts, archive_files, jobs, repeat):
+    results = {}
+    base_path = tempfile.mkdtemp(prefix='clams-appliance-bench-')
+    git_cache_path = ma.GIT_CACHE_PATH
+    try:
+        ma.GIT_CACHE_PATH = pjoin(base_path, 'git-cache')
+        repos_path = pjoin(base_path, 'repos')
+        ma.GALAXY_REPOSITORY = make_galaxy_repo(pjoin(repos_path, 'clams-galaxy'))
+        check_archive_index(base_path)
+        for n_params in param_counts:
+            results.update(bench_appmetadata_to_config_xml_tree(n_params, repeat))
+            results.update(bench_gen_app_config_xml(base_path, n_params, repeat))
+        for n_apps in app_counts:
+            results.update(bench_add_to_tool_conf_xml(n_apps, repeat))
+        for n_apps in app_counts:
+            results.update(bench_process_all_apps(base_path, repos_path, n_apps, param_counts[0], jobs))
+        if archive_files:
+            results.update(bench_gen_db_loc_files(base_path, archive_files))
+    finally:
+        ma.GIT_CACHE_PATH = git_cache_path
+        shutil.rmtree(base_path, ignore_errors=True)
+    return results
+
+
+def print_results(results, baseline=None):
+    width = max(map(len, results))
+    for name, seconds in results.items():
+        line = f'{name:<{width}}  {seconds * 1000:10.1f} ms'
+        if baseline and name in baseline['results']:
+            line += f'  ({seconds / baseline["results"][name]:.2f}x of {baseline["commit"]})'
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark appliance generation with a fake docker engine"
+    )
+    parser.add_argument(
+        '--apps',
+        default=APP_COUNTS,
+        type=int,
+        nargs='+',
+        help=f'Numbers of apps to generate the appliance with. (default: {APP_COUNTS})'
+    )
+    parser.add_argument(
+        '--params',
+        default=PARAM_COUNTS,
+        type=int,
+        nargs='+',
+        help=f'Numbers of runtime parameters in synthetic app metadata. The first one is used for whole-app benchmarks. (default: {PARAM_COUNTS})'
+    )
+    parser.add_argument(
+        '--archive-files',
+        default=ARCHIVE_FILES,
+        type=int,
+        help=f'Number of files in the synthetic archive, 0 to skip. (default: {ARCHIVE_FILES})'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        default=ma.DEFAULT_JOBS,
+        type=ma.positive_int,
+        help=f'Size of the worker pool for apps. (default: {ma.DEFAULT_JOBS})'
+    )
+    parser.add_argument(
+        '--repeat',
+        default=5,
+        type=int,
+        help='Number of runs of micro benchmarks, of which the best is reported. (default: 5)'
+    )
+    parser.add_argument(
+        '--compare',
+        default=None,
+        metavar='RESULTS_FILE',
+        help='Results file of another commit to compare with.'
+    )
+    parser.add_argument(
+        '--no-save',
+        action='store_true',
+        help='Do not write the results file.'
+    )
+    args = parser.parse_args()
+    results = run_benchmarks(args.apps, args.params, args.archive_files, args.jobs, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+    if not args.no_save:
+        commit = get_commit()
+        os.makedirs(RESULTS_PATH, exist_ok=True)
+        results_path = pjoin(RESULTS_PATH, f'{commit}.json')
+        with open(results_path, 'w') as results_file:
+            json.dump({
+                'commit': commit,
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'args': vars(args),
+                'results': results,
+            }, results_file, indent=2)
+        print(f'Results written to {results_path}')
@@ -0,0 +1,222 @@
+#! /usr/bin/env python3
+"""
+An activation proxy that runs in place of a ``lazy`` app in the appliance.
+
+The proxy takes the hostname and the port of the app, creates and starts the app container through the
+docker socket on the first connection, holds the connection until the app serves its metadata, and then
+passes bytes through as is. When no connection has been open for the idle timeout, the app container
+is stopped, to be started again by the next connection.
+
+This file is mounted into a stock python image, hence it must only use the Python standard library.
+"""
+import http.client
+import json
+import signal
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+
+DOCKER_SOCKET = '/var/run/docker.sock'
+CHUNK_SIZE = 1 << 16
+# seconds between checks for idle app containers
+IDLE_CHECK_INTERVAL = 10
+
+
+class DockerConnection(http.client.HTTPConnection):
+    """
+    HTTP connection to the docker engine API over its unix socket.
+    """
+    def __init__(self, socket_path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def docker_request(method, path, body=None):
+    conn = DockerConnection(DOCKER_SOCKET)
+    try:
+        if body is None:
+            conn.request(method, path)
+        else:
+            conn.request(method, path, body=json.dumps(body), headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        content = response.read()
+        try:
+            return response.status, json.loads(content) if content else None
+        except ValueError:
+            return response.status, content.decode('utf8', 'replace')
+    finally:
+        conn.close()
+
+
+class LazyApp:
+    """
+    An app container that is started on demand and stopped when idle.
+    """
+    def __init__(self, config):
+        self.name = config['container']
+        self.create_body = config['create']
+        self.port = config['port']
+        self.idle_timeout = config['idle_timeout']
+        self.start_timeout = config['start_timeout']
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.last_active = time.monotonic()
+        # started and served its metadata, as far as the proxy knows
+        self.ready = False
+
+    def acquire(self):
+        """
+        Registers a new connection, and starts the app unless it's ready. Connections that come in while
+        the app is starting wait for it.
+        """
+        with self.lock:
+            self.connections += 1
+            try:
+                if not self.ready:
+                    self.start()
+            except Exception:
+                self.connections -= 1
+                raise
+
+    def release(self):
+        with self.lock:
+            self.connections -= 1
+            self.last_active = time.monotonic()
+
+    def connect(self):
+        try:
+            return socket.create_connection((self.name, self.port))
+        except OSError:
+            # stopped or crashed behind the proxy's back
+            with self.lock:
+                self.ready = False
+                self.start()
+            return socket.create_connection((self.name, self.port))
+
+    def start(self):
+        started = time.monotonic()
+        status, info = docker_request('GET', f'/containers/{self.name}/json')
+        if status == 404:
+            status, info = docker_request('POST', f'/containers/create?{urllib.parse.urlencode({"name": self.name})}', self.create_body)
+            if status != 201:
+                raise RuntimeError(f'cannot create {self.name}: {info}')
+        elif status != 200:
+            raise RuntimeError(f'cannot inspect {self.name}: {info}')
+        status, info = docker_request('POST', f'/containers/{self.name}/start')
+        # 304 when already running
+        if status not in (204, 304):
+            raise RuntimeError(f'cannot start {self.name}: {info}')
+        self.wait_until_ready()
+        self.ready = True
+        print(f'Started {self.name} ({time.monotonic() - started:.1f}s)', flush=True)
+
+    def wait_until_ready(self):
+        delay = 0.1
+        deadline = time.monotonic() + self.start_timeout
+        while time.monotonic() < deadline:
+            conn = http.client.HTTPConnection(self.name, self.port, timeout=5)
+            try:
+                conn.request('GET', '/')
+                if conn.getresponse().status == 200:
+                    return
+            except (OSError, http.client.HTTPException):
+                # not yet resolvable or listening
+                pass
+            finally:
+                conn.close()
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+        raise TimeoutError(f'{self.name} is not ready after {self.start_timeout}s')
+
+    def stop_if_idle(self):
+        with self.lock:
+            if self.ready and self.connections == 0 and time.monotonic() - self.last_active > self.idle_timeout:
+                docker_request('POST', f'/containers/{self.name}/stop')
+                self.ready = False
+                print(f'Stopped {self.name} after {self.idle_timeout}s of inactivity', flush=True)
+
+    def remove(self):
+        # without the lock, not to wait for a start in progress on shutdown
+        docker_request('DELETE', f'/containers/{self.name}?force=true')
+        self.ready = False
+
+
+def pipe(src, dst):
+    try:
+        for chunk in iter(lambda: src.recv(CHUNK_SIZE), b''):
+            dst.sendall(chunk)
+    except OSError:
+        pass
+    finally:
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+def handle(client, app):
+    try:
+        app.acquire()
+    except Exception as e:
+        print(f'Cannot start {app.name}: {e}', file=sys.stderr, flush=True)
+        client.close()
+        return
+    backend = None
+    try:
+        backend = app.connect()
+        response_pipe = threading.Thread(target=pipe, args=(backend, client), daemon=True)
+        response_pipe.start()
+        pipe(client, backend)
+        response_pipe.join()
+    except Exception as e:
+        print(f'Cannot connect to {app.name}: {e}', file=sys.stderr, flush=True)
+    finally:
+        client.close()
+        if backend is not None:
+            backend.close()
+        app.release()
+
+
+def watch_idle(app):
+    while True:
+        time.sleep(IDLE_CHECK_INTERVAL)
+        try:
+            app.stop_if_idle()
+        except (OSError, http.client.HTTPException) as e:
+            print(f'Cannot stop {app.name}: {e}', file=sys.stderr, flush=True)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Start an app container on demand and stop it when idle"
+    )
+    parser.add_argument('config', help='Path to the JSON configuration generated by the appliance maker')
+    args = parser.parse_args()
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+    app = LazyApp(config)
+    # a container left from the last run may be from an old image or configuration
+    app.remove()
+
+    def shutdown(signum, frame):
+        # the app container is not a compose service, so `docker-compose down` doesn't remove it
+        app.remove()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    listener = socket.create_server(('0.0.0.0', app.port), backlog=128)
+    threading.Thread(target=watch_idle, args=(app,), daemon=True).start()
+    with open(config['ready_file'], 'w'):
+        pass
+    print(f'Proxying {app.name} on demand, on port {app.port}', flush=True)
+    while True:
+        client, _ = listener.accept()
+        threading.Thread(target=handle, args=(client, app), daemon=True).start()
@@ -1,16 +1,28 @@
 #! /usr/bin/env python3
+import contextlib
 import datetime
+import gzip
+import hashlib
+import io
 import json
+import mimetypes
 import os
+import posixpath
+import re
 import socket
+import shutil
 import subprocess
+import sys
+import tarfile
+import threading
 import time
+import urllib.error
 import urllib.request
 import xml.etree.ElementTree as ET
-from http.client import RemoteDisconnected
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
 from io import StringIO
 from os.path import join as pjoin
-from xml.dom import minidom
 
 import docker
 import yaml
@@ -18,12 +30,17 @@ from docker import errors
 from docker.models.containers import Container
 
 ARCHIVE_PATH = 'archive_path'
+ARCHIVE_EXTENSIONS = 'archive_extensions'
+RESULT_CACHE = 'result_cache'
+RESOURCES = 'resources'
+MEDIA_TYPES = ['text', 'video', 'image', 'audio']
 APPS = 'apps'
 APP_PREFIX = 'app-'
 CONSUMERS = 'consumers'
 CONSUMER_PREFIX = 'consumer-'
 # local directory to clone clams-galaxy on the host
 GALAXY_LOCAL_PATH = 'clams-galaxy'
+GALAXY_REPOSITORY = 'https://github.com/clamsproject/clams-galaxy.git'
 # hostname given to the container instantiated from the cloned clams-galaxy
 GALAXY_CONTNAME = 'clams-galaxy'
 # fixed by galaxy-stable image
@@ -33,6 +50,81 @@ DOCKER_NETWORK_NAME = 'clams-appliance'
 CONTAINER_DATA_PATH = '/data'
 HOSTNAME = socket.gethostname()
 DEVELOP = False
+# default size of the worker pool that clones, builds, and probes apps and consumers
+DEFAULT_JOBS = 4
+# load balancer in front of replicated apps, and local directory for its generated configurations
+LOAD_BALANCER_IMAGE = 'nginx:1.25-alpine'
+LOAD_BALANCER_CONF_PATH = 'load-balancers'
+# activation proxy in place of lazy apps, and local directory for the proxy script and its generated configurations
+LAZY_PROXY_IMAGE = 'python:3.11-alpine'
+LAZY_PROXY_FILENAME = 'lazy_proxy.py'
+LAZY_PROXY_CONF_PATH = 'lazy-proxies'
+LAZY_PROXY_CONTPATH = '/lazy-proxy'
+LAZY_PROXY_READY_FILE = '/tmp/lazy-proxy-ready'
+# seconds a lazy app is kept running without connections, and seconds to wait for it to start
+DEFAULT_IDLE_TIMEOUT = 1800
+LAZY_START_TIMEOUT = 600
+# local directory to keep build caches across runs (not removed by `clean`)
+CACHE_PATH = '.appliance-cache'
+BUILD_MANIFEST_PATH = pjoin(CACHE_PATH, 'build-manifest.json')
+# what was generated from which configuration by the last build, to plan minimal changes for the next build
+STATE_PATH = 'appliance.lock'
+# docker image label to store the content hash an image was built from
+BUILD_KEY_LABEL = 'ai.clams.appliance.build-key'
+# dockerfile generated in the galaxy checkout to layer generated files on top of the upstream galaxy image
+GALAXY_OVERLAY_DOCKERFILE = 'Dockerfile.appliance'
+# paths in the galaxy checkout where the appliance maker writes generated files
+GALAXY_GENERATED_PATHS = ['tools', 'display_applications', 'tool-data', 'config']
+# stand-alone client that generated tools use to send MMIF to apps, shipped next to tool XMLs
+MMIF_CLIENT_FILENAME = 'mmif_client.py'
+# app responses cached by generated tools, kept in the galaxy export volume
+RESULT_CACHE_CONTPATH = '/export/clams-result-cache'
+DEFAULT_RESULT_CACHE_SIZE = '10G'
+APPMETADATA_CACHE_PATH = pjoin(CACHE_PATH, 'appmetadata')
+ARCHIVE_INDEX_PATH = pjoin(CACHE_PATH, 'archive-index')
+# exists while generated files in the galaxy checkout are newer than the galaxy image (e.g., after a failed build)
+GALAXY_BUILD_PENDING_PATH = pjoin(CACHE_PATH, 'galaxy-build-pending')
+# indexes of other versions are discarded
+ARCHIVE_INDEX_VERSION = 2
+# seconds to wait for an app container to start serving its metadata
+PROBE_TIMEOUT = 60
+# bare mirrors of app and galaxy repositories, shared across appliances and kept after `clean`
+GIT_CACHE_PATH = pjoin(os.environ.get('XDG_CACHE_HOME', pjoin(os.path.expanduser('~'), '.cache')), 'clams-appliance', 'git')
+# version of MMIF specification of source MMIF files generated for `process` command
+MMIF_VERSION = '0.4.0'
+DOCUMENT_TYPES = {
+    'text': 'TextDocument',
+    'video': 'VideoDocument',
+    'image': 'ImageDocument',
+    'audio': 'AudioDocument',
+}
+# name of the resumable journal `process` command keeps in the output directory
+PROCESS_JOURNAL_FILENAME = 'progress.jsonl'
+# default number of files `process` command processes at the same time
+DEFAULT_PROCESS_WORKERS = 8
+# healthchecks of generated services. apps are healthy when they serve their metadata, and consumers when 
+# they respond at all. failures in the start period (e.g., while loading models) don't count 
+APP_HEALTHCHECK = 'import http.client; c = http.client.HTTPConnection("localhost", 5000, timeout=5); c.request("GET", "/"); assert c.getresponse().status == 200'
+CONSUMER_HEALTHCHECK = 'import http.client; c = http.client.HTTPConnection("localhost", 5000, timeout=5); c.request("GET", "/"); c.getresponse()'
+LOAD_BALANCER_HEALTHCHECK = 'wget -q -O /dev/null http://localhost:5000/'
+HEALTHCHECK_INTERVAL = '5s'
+HEALTHCHECK_TIMEOUT = '5s'
+HEALTHCHECK_RETRIES = 3
+HEALTHCHECK_START_PERIOD = '10m'
+# seconds `up` command waits for all services to become ready
+STARTUP_TIMEOUT = 1800
+# members of the bundle made by `bundle` command; images are in `docker save` format, compressed
+BUNDLE_MANIFEST = 'manifest.json'
+BUNDLE_IMAGES = 'images.tar.gz'
+# generated files the compose file refers to, or to keep after `restore` (files or directories)
+BUNDLE_FILES = ['docker-compose.yml', STATE_PATH, 'config.yaml', LOAD_BALANCER_CONF_PATH, LAZY_PROXY_CONF_PATH]
+# the fastest, as images are large and layers of app images are often compressed already
+BUNDLE_COMPRESSLEVEL = 1
+# resource settings of app containers passed to the compose file as is
+RESOURCE_KEYS = ['cpus', 'mem_limit', 'cpuset', 'shm_size']
+# cores and memory left out of the automatic allocation, for galaxy and the host
+DEFAULT_RESERVED_CPUS = 2
+DEFAULT_RESERVED_MEMORY = '4G'
 GALAXY_CATEGORIES = {
     'AudioDocument': 'Audio',
     'VideoDocument': 'Video',
@@ -40,28 +132,169 @@ GALAXY_CATEGORIES = {
     'Alignment': 'Alignment',
 }
 
-docker_engine = docker.from_env()
+# docker client, set by `init_docker_engine`
+docker_engine = None
+_build_manifest_lock = threading.Lock()
+_git_mirror_locks = {}
+_git_mirror_locks_lock = threading.Lock()
+
+
+class BuildTrace:
+    """
+    Records durations of build phases (from any thread) to report where the time of a build went. 
+    """
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name, category, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.perf_counter() - start, **args)
+
+    def add(self, name, category, start, duration, **args):
+        thread = threading.current_thread()
+        with self.lock:
+            self.events.append({'name': name, 'category': category, 'start': start - self.origin, 'duration': duration,
+                                'thread': thread.ident, 'thread_name': thread.name, 'args': args})
+
+    def to_chrome_trace(self):
+        """
+        Returns the phases in Chrome trace event format, to load in chrome://tracing or https://ui.perfetto.dev
+        """
+        pid = os.getpid()
+        trace_events = []
+        thread_names = {}
+        for event in self.events:
+            thread_names[event['thread']] = event['thread_name']
+            trace_events.append({'name': event['name'], 'cat': event['category'], 'ph': 'X', 'pid': pid, 'tid': event['thread'],
+                                 'ts': round(event['start'] * 1e6), 'dur': round(event['duration'] * 1e6), 'args': event['args']})
+        for tid, thread_name in thread_names.items():
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}})
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def summary(self):
+        by_category = {}
+        for event in self.events:
+            by_category[event['category']] = by_category.get(event['category'], 0) + event['duration']
+        phases = [{k: event[k] for k in ('name', 'category', 'start', 'duration', 'args')}
+                  for event in sorted(self.events, key=lambda e: e['start'])]
+        return {
+            'total': time.perf_counter() - self.origin,
+            # phases of the same category can overlap, so these can add up to more than the total
+            'by_category': by_category,
+            'slowest': sorted(phases, key=lambda e: -e['duration'])[:10],
+            'phases': phases,
+        }
+
+    def write(self, trace_path):
+        """
+        Writes the Chrome trace to the given path, and the summary next to it with ``.summary.json`` extension. 
+        """
+        with self.lock:
+            with open(trace_path, 'w') as trace_file:
+                json.dump(self.to_chrome_trace(), trace_file)
+            summary = self.summary()
+        with open(f'{os.path.splitext(trace_path)[0]}.summary.json', 'w') as summary_file:
+            json.dump(summary, summary_file, indent=2)
+        return summary
+
+
+tracer = BuildTrace()
+
+
+def init_docker_engine(engine=None):
+    """
+    Sets the docker client to use, connecting to the docker daemon from the environment when not given. 
+    Any object with the same interface as ``docker.DockerClient`` can be used (e.g., a fake for benchmarks). 
+    """
+    global docker_engine
+    docker_engine = engine if engine is not None else docker.from_env()
 
 
 #####
 # for xml processing
+CDATA_TAG = '![CDATA['
+
+
 def CDATA(text=None):
-    element = ET.Element('![CDATA[')
+    element = ET.Element(CDATA_TAG)
     element.text = text
     return element
 
-ET._original_serialize_xml = ET._serialize_xml
+
+def xml_to_string(elem, indent='\t'):
+    """
+    Serializes an element in a single pass, with sorted attributes and an element per line (except 
+    elements with text or CDATA, which are kept on one line), so that the same tree always makes the 
+    same string. Whitespace-only text of parsed files is replaced by the indentation. 
+    """
+    out = ['<?xml version="1.0" encoding="utf-8"?>\n']
+    _write_xml_element(out.append, elem, indent, 0)
+    return ''.join(out)
+
+
+def _write_xml_element(write, elem, indent, depth):
+    if elem.tag is ET.Comment:
+        write(f'{indent * depth}<!--{elem.text}-->\n')
+        return
+    attrs = _xml_attrs(elem)
+    children = list(elem)
+    text = elem.text if elem.text and elem.text.strip() else ''
+    if any(child.tag == CDATA_TAG for child in children):
+        # mixed content, where whitespace is significant (e.g., a command or a help text)
+        write(f'{indent * depth}<{elem.tag}{attrs}>{_escape_xml(elem.text or "")}')
+        for child in children:
+            _write_xml_inline(write, child)
+        write(f'</{elem.tag}>\n')
+    elif children:
+        write(f'{indent * depth}<{elem.tag}{attrs}>{_escape_xml(text)}\n')
+        for child in children:
+            _write_xml_element(write, child, indent, depth + 1)
+            if child.tail and child.tail.strip():
+                write(f'{indent * (depth + 1)}{_escape_xml(child.tail.strip())}\n')
+        write(f'{indent * depth}</{elem.tag}>\n')
+    elif text:
+        write(f'{indent * depth}<{elem.tag}{attrs}>{_escape_xml(text)}</{elem.tag}>\n')
+    else:
+        write(f'{indent * depth}<{elem.tag}{attrs} />\n')
 
 
-def _serialize_xml(write, elem, qnames, namespaces, short_empty_elements, **kwargs):
-    if elem.tag == '![CDATA[':
-        write("\n<{}{}]]>\n".format(elem.tag, elem.text))
-        if elem.tail:
-            write(_escape_cdata(elem.tail))
+def _write_xml_inline(write, elem):
+    if elem.tag == CDATA_TAG:
+        # `]]>` can't be in a CDATA section, so it's split across two
+        write(f'<![CDATA[{(elem.text or "").replace("]]>", "]]]]><![CDATA[>")}]]>')
+    elif elem.tag is ET.Comment:
+        write(f'<!--{elem.text}-->')
     else:
-        return ET._original_serialize_xml(write, elem, qnames, namespaces,short_empty_elements, **kwargs)
+        write(f'<{elem.tag}{_xml_attrs(elem)}>{_escape_xml(elem.text or "")}')
+        for child in elem:
+            _write_xml_inline(write, child)
+        write(f'</{elem.tag}>')
+    write(_escape_xml(elem.tail or ''))
+
+
+def _xml_attrs(elem):
+    return ''.join(f' {key}="{_escape_xml(value, True)}"' for key, value in sorted(elem.attrib.items()))
+
 
-ET._serialize_xml = ET._serialize['xml'] = _serialize_xml
+def _escape_xml(text, attribute=False):
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    if attribute:
+        text = text.replace('"', '&quot;').replace('\n', '&#10;').replace('\t', '&#09;')
+    return text
+
+
+def write_xml(file_path, elem):
+    """
+    Writes an element to a file, only when the serialized content is different from the file. 
+    Returns whether the file was written. 
+    """
+    return write_if_changed(file_path, xml_to_string(elem))
 # for xml processing
 #####
 
@@ -71,75 +304,154 @@ def get_docker_image_name(app_name):
 
 
 def clean(directory):
-    import shutil
     for f in os.listdir(directory):
-        if f.startswith(APP_PREFIX) or f.startswith(CONSUMER_PREFIX) or f == GALAXY_LOCAL_PATH:
-            d = pjoin('.', f)
-            if os.path.islink(d):
-                os.unlink(d)
-            elif os.path.isdir(d):
-                shutil.rmtree(d)
+        if f.startswith(APP_PREFIX) or f.startswith(CONSUMER_PREFIX) or f in (GALAXY_LOCAL_PATH, LOAD_BALANCER_CONF_PATH, LAZY_PROXY_CONF_PATH):
+            remove_local_copy(pjoin('.', f))
+    for generated_file in ('docker-compose.yml', STATE_PATH):
+        try:
+            os.remove(generated_file)
+        except OSError:
+            pass
+
+
+def remove_local_copy(d):
+    if os.path.islink(d):
+        os.unlink(d)
+    elif os.path.isdir(d):
+        shutil.rmtree(d)
+
+
+def read_build_manifest():
     try:
-        os.remove('docker-compose.yml', )
-    except OSError:
+        with open(BUILD_MANIFEST_PATH) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_build_manifest(dir_name, **fields):
+    with _build_manifest_lock:
+        manifest = read_build_manifest()
+        manifest.setdefault(dir_name, {}).update(fields)
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        write_atomic(BUILD_MANIFEST_PATH, json.dumps(manifest, indent=2, sort_keys=True))
+
+
+def write_if_changed(file_path, content):
+    """
+    Atomically replaces the file with the given content, but only when the content is different, 
+    so that unchanged files keep their modification times. Returns whether the file was written. 
+    """
+    try:
+        with open(file_path, encoding='utf8') as old_file:
+            if old_file.read() == content:
+                return False
+    except (OSError, UnicodeDecodeError):
         pass
+    write_atomic(file_path, content)
+    return True
+
+
+def write_atomic(file_path, content):
+    """
+    Writes the content to a temporary file next to the file and moves it into place, so that readers 
+    (and later runs, after an interruption) never see a partially written file. 
+    """
+    tmp_path = f'{file_path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as tmp_file:
+        tmp_file.write(content)
+    os.replace(tmp_path, file_path)
 
 
 def read_config(config_file_path):
-    configs = yaml.load(open(config_file_path).read())
+    configs = yaml.safe_load(open(config_file_path).read())
     configs[ARCHIVE_PATH] = os.path.expandvars(os.path.expanduser(configs[ARCHIVE_PATH]))
     return configs
 
 
 def download_galaxy_mods():
     if not os.path.exists(GALAXY_LOCAL_PATH):
-        download('https://github.com/clamsproject/clams-galaxy.git', GALAXY_LOCAL_PATH, [])
+        download(GALAXY_REPOSITORY, GALAXY_LOCAL_PATH)
 
 
-def create_docker_compose(config, export_volumename, rebuild=False, develop=False):
+def create_docker_compose(config, export_volumename, rebuild=False, develop=False, jobs=DEFAULT_JOBS, nocache=False, targets=None, removed=()):
+    """
+    Builds the appliance. When ``targets`` is given, only apps and consumers (prefixed names) in it are 
+    downloaded, built, probed, and have their Galaxy configurations regenerated, and ones in ``removed`` 
+    have their Galaxy configurations deleted, assuming the rest is as generated by the last build. 
+    """
     global DEVELOP
     DEVELOP = develop
     if rebuild:
-        clean('.')
+        with tracer.phase('clean', 'clean'):
+            clean('.')
+    for app_name, app_config in config[APPS].items():
+        if app_config['enabled'] and app_config.get('lazy') and app_config.get('replicas', 1) > 1:
+            raise ValueError(f'app "{app_name}" can\'t be both lazy and replicated')
     prefixed_app_names = list(map(
         lambda x: APP_PREFIX + x,
         [appname for appname in config[APPS].keys() if config[APPS][appname]['enabled']]
     ))
-
-    docker_compose = prep_galaxy(export_volumename, prefixed_app_names, config[ARCHIVE_PATH])
-    process_all_apps(config[APPS], docker_compose, config[ARCHIVE_PATH])
-    process_all_consumers(config[CONSUMERS], docker_compose, config[ARCHIVE_PATH])
-    gen_db_loc_files(config[ARCHIVE_PATH])
-    docker_engine.images.build(path=GALAXY_LOCAL_PATH, dockerfile='Dockerfile', tag=get_docker_image_name(GALAXY_LOCAL_PATH), nocache=True)
-    with open('docker-compose.yml', 'w') as compose_file:
-        yaml.SafeDumper.add_representer(
-            type(None),
-            lambda dumper, value: dumper.represent_scalar(u'tag:yaml.org,2002:null', '')
-        )
-        print(yaml.safe_dump(docker_compose))
-        compose_file.write((yaml.dump(docker_compose)))
+    lazy_app_names = [APP_PREFIX + appname for appname, app_config in config[APPS].items() if app_config.get('lazy')]
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        galaxy_download = pool.submit(download_galaxy_mods)
+        app_pipelines = submit_app_pipelines(pool, config[APPS], nocache, targets)
+        consumer_pipelines = submit_consumer_pipelines(pool, config[CONSUMERS], nocache, targets)
+        # generated XMLs are written into the galaxy checkout, so everything below needs it in place
+        galaxy_download.result()
+        docker_compose = prep_galaxy(export_volumename, prefixed_app_names, config[ARCHIVE_PATH], lazy_app_names)
+        galaxy_changed = install_mmif_client()
+        for name in removed:
+            galaxy_changed |= remove_galaxy_configs(name)
+        galaxy_changed |= process_all_apps(config[APPS], docker_compose, config[ARCHIVE_PATH], app_pipelines, get_result_cache_size(config), allocate_resources(config))
+        galaxy_changed |= process_all_consumers(config[CONSUMERS], docker_compose, config[ARCHIVE_PATH], targets, export_volumename)
+        galaxy_changed |= gen_db_loc_files(config[ARCHIVE_PATH], config.get(ARCHIVE_EXTENSIONS))
+        # only files copied into the galaxy image affect it, changes only in the compose file (e.g., `replicas`) don't
+        if galaxy_changed:
+            os.makedirs(CACHE_PATH, exist_ok=True)
+            open(GALAXY_BUILD_PENDING_PATH, 'w').close()
+        # display XMLs don't need consumer images, so consumers can keep building alongside galaxy
+        if targets is None or os.path.exists(GALAXY_BUILD_PENDING_PATH) or not docker_engine.images.list(name=get_docker_image_name(GALAXY_LOCAL_PATH)):
+            with tracer.phase(GALAXY_LOCAL_PATH, 'galaxy build'):
+                build_galaxy_image(nocache)
+            if os.path.exists(GALAXY_BUILD_PENDING_PATH):
+                os.remove(GALAXY_BUILD_PENDING_PATH)
+        for consumer_pipeline in consumer_pipelines.values():
+            consumer_pipeline.result()
+    yaml.SafeDumper.add_representer(
+        type(None),
+        lambda dumper, value: dumper.represent_scalar(u'tag:yaml.org,2002:null', '')
+    )
+    print(yaml.safe_dump(docker_compose))
+    write_if_changed('docker-compose.yml', yaml.dump(docker_compose))
+    write_state(config)
 
 
 def create_base_compose_obj():
-    return {'version': '3', 'services': {}, 'networks': {DOCKER_NETWORK_NAME: None}, 'volumes': {}}
+    # healthcheck conditions in `depends_on` are only available in version 2 file format
+    # the network has a fixed name (not prefixed by the compose project name), for lazy app containers to join
+    return {'version': '2.4', 'services': {}, 'networks': {DOCKER_NETWORK_NAME: {'name': DOCKER_NETWORK_NAME}}, 'volumes': {}}
 
 
-def prep_galaxy(export_volumename, dependencies, host_data_path):
-    download_galaxy_mods()
+def prep_galaxy(export_volumename, dependencies, host_data_path, lazy_dependencies=()):
     compose_obj = create_base_compose_obj()
     galaxy_service = get_service_def(GALAXY_CONTNAME, int(PRIMARY_HOSTPORT))
     # even though we configure `http` address to be bound to 0.0.0.0:5000 in galaxy.yml, 
     # external communication still needs to be using port 80 for underlying wsgi modules to work
-    galaxy_service[GALAXY_CONTNAME].update({'privileged': True, 'depends_on': dependencies, 'ports': [f'{PRIMARY_HOSTPORT}:{GALAXY_CONTPORT}']})
+    # galaxy starts only after all apps are ready to take jobs, except lazy apps, which start with their first job
+    depends_on = {dependency: {'condition': 'service_started' if dependency in lazy_dependencies else 'service_healthy'}
+                  for dependency in dependencies}
+    galaxy_service[GALAXY_CONTNAME].update({'privileged': True, 'depends_on': depends_on, 'ports': [f'{PRIMARY_HOSTPORT}:{GALAXY_CONTPORT}']})
     compose_obj['services'].update(galaxy_service)
     add_data_volume(GALAXY_CONTNAME, compose_obj, host_data_path)
     add_galaxy_export_volume(compose_obj, GALAXY_CONTNAME, export_volumename)
     return compose_obj
 
 
-def get_service_def(cont_hostname, port):
+def get_service_def(cont_hostname, port, image=None):
     service_def = {cont_hostname: {
-        'image': get_docker_image_name(cont_hostname),
+        'image': image if image is not None else get_docker_image_name(cont_hostname),
         'container_name': cont_hostname,
         'networks': [DOCKER_NETWORK_NAME],
     }}
@@ -148,20 +460,89 @@ def get_service_def(cont_hostname, port):
     return service_def
 
 
-def process_all_apps(apps_config, docker_compose_obj, host_data_path):
+def submit_app_pipelines(pool, apps_config, nocache=False, targets=None):
+    """
+    Schedules clone, build, and metadata probe of every enabled app (or only ones in ``targets``) on the worker pool. 
+    Returns a dict from prefixed app names to futures of their config XML trees, in the configuration order. 
+    """
+    cont_port = 5000
+    pipelines = {}
+    for app_name, app_config in apps_config.items():
+        app_name = f'{APP_PREFIX}{app_name}'
+        if app_config['enabled'] and (targets is None or app_name in targets):
+            pipelines[app_name] = pool.submit(run_app_pipeline, app_name, app_config, cont_port, nocache)
+    return pipelines
+
+
+def run_app_pipeline(app_name, app_config, cont_port, nocache=False):
+    download_app(app_name, app_config)
+    with tracer.phase(app_name, 'image build'):
+        build_docker_image(app_name, nocache)
+    with tracer.phase(app_name, 'probe'):
+        return get_app_config_xml_tree(app_name, app_config, cont_port)
+
+
+def submit_consumer_pipelines(pool, consumers_config, nocache=False, targets=None):
+    """
+    Schedules clone and build of every enabled consumer (or only ones in ``targets``) on the worker pool. 
+    Returns a dict from prefixed consumer names to futures, in the configuration order. 
+    """
+    if not consumers_config:
+        consumers_config = {}
+    pipelines = {}
+    for consumer_name, consumer_config in consumers_config.items():
+        consumer_name = f'{CONSUMER_PREFIX}{consumer_name}'
+        if consumer_config['enabled'] and (targets is None or consumer_name in targets):
+            pipelines[consumer_name] = pool.submit(run_consumer_pipeline, consumer_name, consumer_config, nocache)
+    return pipelines
+
+
+def run_consumer_pipeline(consumer_name, consumer_config, nocache=False):
+    download_app(consumer_name, consumer_config)
+    with tracer.phase(consumer_name, 'image build'):
+        build_docker_image(consumer_name, nocache)
+
+
+def process_all_apps(apps_config, docker_compose_obj, host_data_path, app_pipelines, result_cache_size=None, resources=None):
+    """
+    Adds enabled apps to the compose object, and generates Galaxy tool configurations of apps with 
+    pipelines. Returns whether any generated file in the galaxy checkout has changed. 
+    """
+    changed = False
     tool_conf_path = pjoin(GALAXY_LOCAL_PATH, 'config', 'tool_conf.xml')
     tool_conf_tree = ET.parse(tool_conf_path)
     cont_port = 5000
+    enabled_app_names = [f'{APP_PREFIX}{app_name}' for app_name, app_config in apps_config.items() if app_config['enabled']]
+    prune_tool_conf_xml(tool_conf_tree, enabled_app_names)
+    sections, tool_sections = index_tool_conf_sections(tool_conf_tree)
+    if resources is None:
+        resources = {}
+    # results are consumed in the configuration order, no matter which pipeline finishes first,
+    # so that the tool_conf.xml is always the same for the same configuration
     for host_port, (app_name, app_config) in enumerate(apps_config.items(), 8001):
         app_name = f'{APP_PREFIX}{app_name}'
         if app_config['enabled']:
-            download_app(app_name, app_config)
-            build_docker_image(app_name)
-            add_to_docker_compose(app_name, docker_compose_obj, host_port)
-            add_data_volume(app_name, docker_compose_obj, host_data_path)
-            config_xml_tree = gen_app_config_xml(app_name, app_config, cont_port)
-            add_to_tool_conf_xml(tool_conf_tree, config_xml_tree, app_name)
-    tool_conf_tree.write(tool_conf_path, encoding='utf-8', xml_declaration=True)
+            if app_config.get('lazy'):
+                add_lazy_app_to_docker_compose(app_name, docker_compose_obj, host_port, host_data_path, resources.get(app_name, {}),
+                                               app_config.get('idle_timeout', DEFAULT_IDLE_TIMEOUT))
+            elif app_config.get('replicas', 1) > 1:
+                add_replicas_to_docker_compose(app_name, docker_compose_obj, host_port, app_config['replicas'], host_data_path, resources)
+            else:
+                add_to_docker_compose(app_name, docker_compose_obj, host_port)
+                add_data_volume(app_name, docker_compose_obj, host_data_path)
+                add_healthcheck(app_name, docker_compose_obj, python_healthcheck(APP_HEALTHCHECK))
+                docker_compose_obj['services'][app_name].update(resources.get(app_name, {}))
+            if app_name not in app_pipelines:
+                # not a target of this build, the tool config is up to date
+                continue
+            config_xml_tree = app_pipelines[app_name].result()
+            with tracer.phase(app_name, 'xml generation'):
+                changed |= gen_app_config_xml(app_name, config_xml_tree, cont_port, result_cache_size if app_config.get('cache', True) else None)
+                add_to_tool_conf_xml(tool_conf_tree, config_xml_tree, app_name, sections, tool_sections)
+    remove_empty_sections(tool_conf_tree)
+    with tracer.phase('tool_conf.xml', 'xml generation'):
+        changed |= write_xml(tool_conf_path, tool_conf_tree.getroot())
+    return changed
 
 
 def get_tool_config_xml_fullpath(app_name):
@@ -172,21 +553,36 @@ def get_tool_config_xml_filename(app_name):
     return get_docker_image_name(app_name) + '.xml'
 
 
-def process_all_consumers(consumers_config, docker_compose_obj, host_data_path):
+def process_all_consumers(consumers_config, docker_compose_obj, host_data_path, targets=None, export_volumename=None):
+    """
+    Adds enabled consumers to the compose object, and generates Galaxy display applications of consumers 
+    in ``targets`` (all, when not given). Returns whether any generated file in the galaxy checkout has changed. 
+    """
+    changed = False
     datatypes_conf_path = pjoin(GALAXY_LOCAL_PATH, 'config', 'datatypes_conf.xml')
     datatypes_conf_tree = ET.parse(datatypes_conf_path)
     if not consumers_config:
         consumers_config = {}
+    enabled_consumer_names = [f'{CONSUMER_PREFIX}{consumer_name}' for consumer_name, consumer_config in consumers_config.items() if consumer_config['enabled']]
+    prune_datatypes_conf_xml(datatypes_conf_tree, enabled_consumer_names)
     for port, (consumer_name, consumer_config) in enumerate(consumers_config.items(), 9001):
         consumer_name = f'{CONSUMER_PREFIX}{consumer_name}'
         if consumer_config['enabled']:
-            download_app(consumer_name, consumer_config)
-            build_docker_image(consumer_name)
             add_to_docker_compose(consumer_name, docker_compose_obj, port)
             add_data_volume(consumer_name, docker_compose_obj, host_data_path, flask_static=True)
-            gen_display_app_xml(consumer_name, port, consumer_config['description'])
-            add_to_datatypes_conf_xml(datatypes_conf_tree, consumer_name)
-    datatypes_conf_tree.write(datatypes_conf_path, encoding='utf-8')
+            add_healthcheck(consumer_name, docker_compose_obj, python_healthcheck(CONSUMER_HEALTHCHECK))
+            direct_access = bool(consumer_config.get('direct_access')) and export_volumename is not None
+            if direct_access:
+                # same path as in galaxy, so that galaxy's dataset paths are valid in the consumer
+                docker_compose_obj['services'][consumer_name]['volumes'].append(f'{export_volumename}:/export:ro')
+            if targets is not None and consumer_name not in targets:
+                continue
+            with tracer.phase(consumer_name, 'xml generation'):
+                changed |= gen_display_app_xml(consumer_name, port, consumer_config['description'], direct_access)
+                add_to_datatypes_conf_xml(datatypes_conf_tree, consumer_name)
+    with tracer.phase('datatypes_conf.xml', 'xml generation'):
+        changed |= write_xml(datatypes_conf_path, datatypes_conf_tree.getroot())
+    return changed
 
 
 def get_display_app_xml_fullpath(consumer_name):
@@ -201,6 +597,211 @@ def add_to_docker_compose(cont_hostname, docker_compose_obj, port):
     docker_compose_obj['services'].update(get_service_def(cont_hostname, port))
 
 
+def add_replicas_to_docker_compose(app_name, docker_compose_obj, port, replicas, host_data_path, resources=None):
+    """
+    Adds replicas of an app, and a load balancer that takes the hostname and the host port of the app, 
+    so that tools and other services can keep using the app as if it were a single container. 
+    """
+    replica_names = [f'{app_name}-{i}' for i in range(1, replicas + 1)]
+    for replica_name in replica_names:
+        docker_compose_obj['services'].update(get_service_def(replica_name, 5000, get_docker_image_name(app_name)))
+        add_data_volume(replica_name, docker_compose_obj, host_data_path)
+        add_healthcheck(replica_name, docker_compose_obj, python_healthcheck(APP_HEALTHCHECK))
+        docker_compose_obj['services'][replica_name].update((resources or {}).get(replica_name, {}))
+    os.makedirs(LOAD_BALANCER_CONF_PATH, exist_ok=True)
+    conf_path = pjoin(LOAD_BALANCER_CONF_PATH, f'{app_name}.conf')
+    write_if_changed(conf_path, gen_load_balancer_conf(app_name, replica_names, 5000))
+    balancer_def = get_service_def(app_name, port, LOAD_BALANCER_IMAGE)
+    balancer_def[app_name].update({
+        'depends_on': replica_names,
+        'volumes': [f'./{conf_path}:/etc/nginx/conf.d/default.conf:ro'],
+    })
+    docker_compose_obj['services'].update(balancer_def)
+    # proxied to replicas, so the balancer is healthy once any replica is
+    add_healthcheck(app_name, docker_compose_obj, ['CMD-SHELL', LOAD_BALANCER_HEALTHCHECK])
+
+
+def gen_load_balancer_conf(app_name, replica_names, cont_port):
+    # requests and responses are streamed as is (MMIF can be large), and a single request can take hours
+    servers = ''.join(f'    server {replica_name}:{cont_port};\n' for replica_name in replica_names)
+    return (
+        f'upstream {app_name} {{\n'
+        f'    least_conn;\n'
+        f'{servers}'
+        f'    keepalive 16;\n'
+        f'}}\n'
+        f'server {{\n'
+        f'    listen {cont_port};\n'
+        f'    client_max_body_size 0;\n'
+        f'    proxy_request_buffering off;\n'
+        f'    proxy_buffering off;\n'
+        f'    proxy_read_timeout 1d;\n'
+        f'    proxy_send_timeout 1d;\n'
+        f'    location / {{\n'
+        f'        proxy_pass http://{app_name};\n'
+        f'        proxy_http_version 1.1;\n'
+        f'        proxy_set_header Connection "";\n'
+        f'        proxy_set_header Host $host;\n'
+        f'    }}\n'
+        f'}}\n'
+    )
+
+
+def add_healthcheck(cont_hostname, docker_compose_obj, test):
+    docker_compose_obj['services'][cont_hostname]['healthcheck'] = {
+        'test': test,
+        'interval': HEALTHCHECK_INTERVAL,
+        'timeout': HEALTHCHECK_TIMEOUT,
+        'retries': HEALTHCHECK_RETRIES,
+        'start_period': HEALTHCHECK_START_PERIOD,
+    }
+
+
+def python_healthcheck(code):
+    # images of apps and consumers don't necessarily have curl or wget, but python ($$ escapes compose interpolation)
+    return ['CMD-SHELL', f"$$(command -v python3 || command -v python) -c '{code}'"]
+
+
+def add_lazy_app_to_docker_compose(app_name, docker_compose_obj, port, host_data_path, resources, idle_timeout):
+    """
+    Adds an activation proxy that takes the hostname and the host port of the app, and starts the app 
+    container through the docker socket on the first connection, instead of the app itself. 
+    """
+    os.makedirs(LAZY_PROXY_CONF_PATH, exist_ok=True)
+    with open(pjoin(os.path.dirname(os.path.abspath(__file__)), LAZY_PROXY_FILENAME), encoding='utf8') as proxy_file:
+        write_if_changed(pjoin(LAZY_PROXY_CONF_PATH, LAZY_PROXY_FILENAME), proxy_file.read())
+    conf_filename = f'{app_name}.json'
+    write_if_changed(pjoin(LAZY_PROXY_CONF_PATH, conf_filename), json.dumps(
+        gen_lazy_proxy_conf(app_name, 5000, host_data_path, resources, idle_timeout), indent=2))
+    proxy_def = get_service_def(app_name, port, LAZY_PROXY_IMAGE)
+    proxy_def[app_name].update({
+        'command': ['python', posixpath.join(LAZY_PROXY_CONTPATH, LAZY_PROXY_FILENAME), posixpath.join(LAZY_PROXY_CONTPATH, conf_filename)],
+        'volumes': [f'./{LAZY_PROXY_CONF_PATH}:{LAZY_PROXY_CONTPATH}:ro', '/var/run/docker.sock:/var/run/docker.sock'],
+    })
+    docker_compose_obj['services'].update(proxy_def)
+    # checking the proxy port would start the app
+    add_healthcheck(app_name, docker_compose_obj, ['CMD-SHELL', f'test -f {LAZY_PROXY_READY_FILE}'])
+
+
+def gen_lazy_proxy_conf(app_name, cont_port, host_data_path, resources, idle_timeout):
+    # the app container is created by the proxy with the docker engine API, not by docker-compose
+    cont_name = f'{app_name}-lazy'
+    host_config = {
+        'Binds': [f'{os.path.abspath(os.path.expanduser(host_data_path))}:{CONTAINER_DATA_PATH}:ro'],
+        'NetworkMode': DOCKER_NETWORK_NAME,
+    }
+    if 'cpus' in resources:
+        host_config['NanoCpus'] = int(float(resources['cpus']) * 10 ** 9)
+    if 'mem_limit' in resources:
+        host_config['Memory'] = parse_size(str(resources['mem_limit']))
+    if 'cpuset' in resources:
+        host_config['CpusetCpus'] = str(resources['cpuset'])
+    if 'shm_size' in resources:
+        host_config['ShmSize'] = parse_size(str(resources['shm_size']))
+    return {
+        'container': cont_name,
+        'port': cont_port,
+        'idle_timeout': idle_timeout,
+        'start_timeout': LAZY_START_TIMEOUT,
+        'ready_file': LAZY_PROXY_READY_FILE,
+        'create': {
+            'Image': get_docker_image_name(app_name),
+            'Hostname': cont_name,
+            'HostConfig': host_config,
+            'NetworkingConfig': {'EndpointsConfig': {DOCKER_NETWORK_NAME: {'Aliases': [cont_name]}}},
+        },
+    }
+
+
+def allocate_resources(config):
+    """
+    Returns a dict from container names of enabled apps (replicas, for replicated apps) to their resource 
+    settings in the compose file. Settings in app configurations apply to each container as is. When the 
+    top-level ``resources`` is set, cores and memory of the docker host, less the reserved ones and ones 
+    explicitly given to apps, are split across the rest of the containers by the ``weight`` of their apps, 
+    into non-overlapping cpusets and memory limits. 
+    """
+    allocation = {}
+    weights = {}
+    for app_name, app_config in config[APPS].items():
+        if not app_config['enabled']:
+            continue
+        app_name = f'{APP_PREFIX}{app_name}'
+        app_resources = app_config.get(RESOURCES) or {}
+        replicas = app_config.get('replicas', 1)
+        cont_names = [app_name] if replicas <= 1 else [f'{app_name}-{i}' for i in range(1, replicas + 1)]
+        for cont_name in cont_names:
+            allocation[cont_name] = {key: app_resources[key] for key in RESOURCE_KEYS if key in app_resources}
+            weights[cont_name] = float(app_resources.get('weight', 1))
+    auto_config = config.get(RESOURCES)
+    if not auto_config:
+        return allocation
+    if not isinstance(auto_config, dict):
+        auto_config = {}
+    # as available to containers, which can be less than the host has (e.g., the VM of Docker Desktop)
+    engine_info = docker_engine.info()
+    cores = list(range(engine_info['NCPU']))[int(auto_config.get('reserved_cpus', DEFAULT_RESERVED_CPUS)):]
+    memory = engine_info['MemTotal'] - parse_size(str(auto_config.get('reserved_memory', DEFAULT_RESERVED_MEMORY)))
+    for settings in allocation.values():
+        if 'cpuset' in settings:
+            taken = parse_cpuset(str(settings['cpuset']))
+            cores = [core for core in cores if core not in taken]
+        if 'mem_limit' in settings:
+            memory -= parse_size(str(settings['mem_limit']))
+    cpu_conts = [cont_name for cont_name, settings in allocation.items() if 'cpuset' not in settings]
+    if len(cpu_conts) > len(cores):
+        raise ValueError(f'cannot give {len(cpu_conts)} app containers separate cores, only {len(cores)} cores are available for apps')
+    start = 0
+    for cont_name, n_cores in zip(cpu_conts, split_by_weight(len(cores) - len(cpu_conts), [weights[c] for c in cpu_conts])):
+        # every container gets at least one core
+        allocation[cont_name]['cpuset'] = format_cpuset(cores[start:start + n_cores + 1])
+        start += n_cores + 1
+    mem_conts = [cont_name for cont_name, settings in allocation.items() if 'mem_limit' not in settings]
+    if mem_conts and memory < len(mem_conts) * 1024 ** 2:
+        raise ValueError(f'not enough memory left for {len(mem_conts)} app containers')
+    for cont_name, mem_bytes in zip(mem_conts, split_by_weight(memory, [weights[c] for c in mem_conts])):
+        allocation[cont_name]['mem_limit'] = f'{mem_bytes // 1024 ** 2}m'
+    for cont_name, settings in allocation.items():
+        print(f"Resources of {cont_name}: {', '.join(f'{key} {value}' for key, value in settings.items())}")
+    return allocation
+
+
+def split_by_weight(total, weights):
+    """
+    Splits an integer amount in proportion to weights, so that the parts add up to ``total``. 
+    Leftovers of rounding go to the largest remainders, and to earlier ones on ties. 
+    """
+    weight_sum = sum(weights)
+    if not weights or weight_sum <= 0:
+        return [0] * len(weights)
+    parts = [int(total * weight // weight_sum) for weight in weights]
+    by_remainder = sorted(range(len(weights)), key=lambda i: (-(total * weights[i] / weight_sum - parts[i]), i))
+    for i in by_remainder[:total - sum(parts)]:
+        parts[i] += 1
+    return parts
+
+
+def parse_cpuset(cpuset):
+    """
+    Parses a cpuset string in docker style (e.g., ``0-3,8``) into a set of core numbers. 
+    """
+    cores = set()
+    for part in cpuset.split(','):
+        first, _, last = part.strip().partition('-')
+        cores.update(range(int(first), int(last or first) + 1))
+    return cores
+
+
+def format_cpuset(cores):
+    ranges = []
+    for core in cores:
+        if ranges and ranges[-1][1] == core - 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ','.join(str(first) if first == last else f'{first}-{last}' for first, last in ranges)
+
+
 def add_data_volume(cont_hostname, docker_compose_obj, host_data_path, flask_static=False):
     # 'ro' for read-only
     docker_compose_obj['services'][cont_hostname].update({'volumes': [f'{host_data_path}:{CONTAINER_DATA_PATH}:ro']})
@@ -217,53 +818,313 @@ def add_galaxy_export_volume(docker_compose_obj, cont_hostname, volumename):
     docker_compose_obj['volumes'][volumename] = {'external': True}
 
 
-def build_docker_image(dir_name):
-    print(f"Building a Docker image from {dir_name}...")
-    image = docker_engine.images.build(path=dir_name, dockerfile='Dockerfile', tag=get_docker_image_name(dir_name), nocache=False)[0]
+def build_docker_image(dir_name, nocache=False):
+    image_name = get_docker_image_name(dir_name)
+    commit = get_git_commit(dir_name)
+    context_hash = hash_build_context(dir_name)
+    build_key = hashlib.sha256(f'{commit}:{context_hash}'.encode('utf8')).hexdigest()
+    image = None if nocache else get_cached_image(image_name, build_key)
+    if image is not None:
+        print(f"Build inputs of {dir_name} are unchanged, reusing: {image.id}")
+    else:
+        print(f"Building a Docker image from {dir_name}...")
+        image = build_image(image_name, path=dir_name, dockerfile='Dockerfile', nocache=nocache, labels={BUILD_KEY_LABEL: build_key})
+        print(f"Built: {image.id}")
+    update_build_manifest(dir_name, commit=commit, context=context_hash, key=build_key, image=image.id)
+    return image
+
+
+def build_galaxy_image(nocache=False):
+    """
+    Builds the galaxy image in two stages, so that generated tools, display apps, ``.loc`` files and 
+    conf files don't invalidate the docker layer cache of the (slow) galaxy installation. 
+    The first stage builds the upstream Dockerfile from the committed galaxy checkout, without 
+    any generated files, and the second stage copies generated files on top of it. 
+    """
+    galaxy_image_name = get_docker_image_name(GALAXY_LOCAL_PATH)
+    base_image_name = f'{galaxy_image_name}-base'
+    # local modifications in develop mode (or outside of git) can't be told apart from generated files
+    base_context = None if DEVELOP else get_pristine_galaxy_context()
+    overlay_dockerfile = None if base_context is None else gen_galaxy_overlay_dockerfile(base_image_name)
+    if overlay_dockerfile is None:
+        if base_context is not None:
+            print(f"Warning: no COPY or ADD instruction in {GALAXY_LOCAL_PATH}/Dockerfile copies generated files, building in a single stage")
+        print(f"Building a Docker image from {GALAXY_LOCAL_PATH}...")
+        build_image(galaxy_image_name, path=GALAXY_LOCAL_PATH, dockerfile='Dockerfile', nocache=nocache)
+        return
+    print(f"Building a Docker image from {GALAXY_LOCAL_PATH} (upstream)...")
+    build_image(base_image_name, fileobj=base_context, custom_context=True, dockerfile='Dockerfile', nocache=nocache)
+    write_if_changed(pjoin(GALAXY_LOCAL_PATH, GALAXY_OVERLAY_DOCKERFILE), overlay_dockerfile)
+    print(f"Building a Docker image from {GALAXY_LOCAL_PATH} (generated files)...")
+    image = build_image(galaxy_image_name, path=GALAXY_LOCAL_PATH, dockerfile=GALAXY_OVERLAY_DOCKERFILE, nocache=nocache)
     print(f"Built: {image.id}")
 
 
-def gen_app_config_xml(app_name, app_config, port):
+def build_image(tag, **build_kwargs):
+    """
+    Builds an image just like ``docker_engine.images.build``, but streams the build log to record 
+    the duration of each build step in the build trace. Returns the built image. 
+    """
+    build_log = []
+    image_id = None
+    step = None
+    step_start = None
+    for chunk in docker_engine.api.build(tag=tag, decode=True, **build_kwargs):
+        build_log.append(chunk)
+        line = chunk.get('stream', '')
+        if 'error' in chunk or line.startswith('Step '):
+            if step is not None:
+                tracer.add(step, 'docker step', step_start, time.perf_counter() - step_start, image=tag)
+                step = None
+            if 'error' in chunk:
+                raise docker.errors.BuildError(chunk['error'], build_log)
+            step = line.strip()
+            step_start = time.perf_counter()
+        if 'ID' in chunk.get('aux', {}):
+            image_id = chunk['aux']['ID']
+    if step is not None:
+        tracer.add(step, 'docker step', step_start, time.perf_counter() - step_start, image=tag)
+    if image_id is None:
+        raise docker.errors.BuildError('Unknown', build_log)
+    return docker_engine.images.get(image_id)
+
+
+def get_pristine_galaxy_context():
+    """
+    Returns the committed tree of the galaxy checkout as a tar stream to use as a build context, 
+    or None if the checkout is not a git repository. 
+    """
+    proc = subprocess.run(['git', '-C', GALAXY_LOCAL_PATH, 'archive', '--format=tar', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return io.BytesIO(proc.stdout) if proc.returncode == 0 else None
+
+
+def gen_galaxy_overlay_dockerfile(base_image_name):
+    """
+    Generates a Dockerfile that repeats ``COPY`` and ``ADD`` instructions of the (last stage of) upstream 
+    galaxy Dockerfile that copy generated files, but on top of the image built from the upstream Dockerfile. 
+    Note that ``RUN`` instructions are not repeated, hence generated files must not be pre-processed 
+    during the image build. Returns None when no instruction copies generated files (e.g., after 
+    upstream changes to the Dockerfile), as the overlay would ship without them. 
+    """
+    copies = []
+    workdir = None
+    for instruction in read_dockerfile_instructions(pjoin(GALAXY_LOCAL_PATH, 'Dockerfile')):
+        keyword, _, arguments = instruction.partition(' ')
+        keyword = keyword.upper()
+        if keyword == 'FROM':
+            copies = []
+            workdir = None
+        elif keyword == 'WORKDIR':
+            workdir = instruction
+        elif keyword in ('COPY', 'ADD') and copies_generated_files(arguments):
+            copies.append((workdir, instruction))
+    if not copies:
+        return None
+    lines = [f'FROM {base_image_name}']
+    last_workdir = None
+    for copy_workdir, instruction in copies:
+        if copy_workdir != last_workdir:
+            lines.append(copy_workdir if copy_workdir is not None else 'WORKDIR /')
+            last_workdir = copy_workdir
+        lines.append(instruction)
+    if last_workdir != workdir:
+        lines.append(workdir if workdir is not None else 'WORKDIR /')
+    return '\n'.join(lines) + '\n'
+
+
+def read_dockerfile_instructions(dockerfile_path):
+    instructions = []
+    continued = ''
+    with open(dockerfile_path) as dockerfile:
+        for line in dockerfile:
+            line = line.strip()
+            if not continued and (not line or line.startswith('#')):
+                continue
+            if line.endswith('\\'):
+                continued += line[:-1] + ' '
+            else:
+                instructions.append(continued + line)
+                continued = ''
+    if continued:
+        instructions.append(continued.strip())
+    return instructions
+
+
+def copies_generated_files(copy_arguments):
+    copy_arguments = copy_arguments.strip()
+    if copy_arguments.startswith('['):
+        paths = json.loads(copy_arguments)
+    else:
+        paths = copy_arguments.split()
+    if any(flag.startswith('--from') for flag in paths):
+        return False
+    sources = [p for p in paths if not p.startswith('--')][:-1]
+    for source in sources:
+        source = os.path.normpath(source.lstrip('/'))
+        for generated in GALAXY_GENERATED_PATHS:
+            if source == '.' or source == generated or source.startswith(generated + os.sep) or generated.startswith(source + os.sep):
+                return True
+    return False
+
+
+def get_cached_image(image_name, build_key):
+    """
+    Returns the image tagged with the given name only when it was built from the inputs the build key represents. 
+    """
+    try:
+        image = docker_engine.images.get(image_name)
+    except docker.errors.ImageNotFound:
+        return None
+    if image.labels.get(BUILD_KEY_LABEL) == build_key:
+        return image
+    return None
+
+
+def get_git_commit(repo_dir):
+    proc = subprocess.run(['git', '-C', repo_dir, 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return proc.stdout.strip() if proc.returncode == 0 else None
+
+
+def hash_build_context(context_dir):
+    """
+    Hashes paths, executable bits, and contents of all files in a docker build context (``Dockerfile`` included). 
+    Git metadata is excluded, as the resolved commit is a separate part of the build key. 
+    """
+    context_hash = hashlib.sha256()
+    for root, dirs, files in os.walk(context_dir):
+        dirs[:] = sorted(d for d in dirs if d != '.git')
+        for f_name in sorted(files):
+            f_path = pjoin(root, f_name)
+            context_hash.update(os.path.relpath(f_path, context_dir).encode('utf8') + b'\0')
+            if os.path.islink(f_path):
+                context_hash.update(b'l' + os.readlink(f_path).encode('utf8') + b'\0')
+                continue
+            context_hash.update(b'x' if os.access(f_path, os.X_OK) else b'f')
+            with open(f_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    context_hash.update(chunk)
+            context_hash.update(b'\0')
+    return context_hash.hexdigest()
+
+
+def get_app_config_xml_tree(app_name, app_config, port):
     image_name = get_docker_image_name(app_name)
     if os.path.exists(pjoin(app_name, 'config.xml')):
         config_xml_tree = ET.parse(pjoin(app_name, 'config.xml'))
     elif docker_engine.images.list(name=image_name):
-        image_name = get_docker_image_name(app_name)
-        container: Container = docker_engine.containers.run(image=image_name, remove=True, detach=True,
-                                                            ports={port: PRIMARY_HOSTPORT})
-        attempts = 0
-        appmetadata = None
-        try:
-            while attempts < 20 and appmetadata is None:
-                try:
-                    time.sleep(1)  # give a second for server to start update 
-                    appmetadata = urllib.request.urlopen(f'http://127.0.0.1:{PRIMARY_HOSTPORT}').read()
-                    config_xml_tree = appmetadata_to_config_xml_tree(appmetadata)
-                    break
-                    # generate xmltree
-                except (RemoteDisconnected, ConnectionResetError):
-                    attempts += 1
-            else:
-                # TODO (krim @ 7/13/21): should I just use app_config and continue? 
-                raise ConnectionError(f"app \"{app_name}\" is not responding, and galaxy config.xml cannot be generated")
-        finally:
-            container.stop()
+        config_xml_tree = appmetadata_to_config_xml_tree(get_appmetadata(app_name, port))
     else:
         config_xml_tree = configyml_to_config_xml_tree(app_name, app_config)
+    return config_xml_tree
+
+
+def get_appmetadata(app_name, port):
+    """
+    Returns the app metadata served by the app image. As the metadata can't change without the image changing, 
+    it is cached by the image ID, and an image is started only when it's never been probed before. 
+    """
+    image = docker_engine.images.get(get_docker_image_name(app_name))
+    cache_path = pjoin(APPMETADATA_CACHE_PATH, f'{image.id.split(":")[-1]}.json')
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        pass
+    appmetadata = probe_appmetadata(app_name, image.id, port)
+    os.makedirs(APPMETADATA_CACHE_PATH, exist_ok=True)
+    write_atomic(cache_path, json.dumps(appmetadata))
+    return appmetadata
 
+
+def probe_appmetadata(app_name, image_id, port):
+    # docker picks a free host port, so that probes can run side by side and never collide with a running galaxy
+    container: Container = docker_engine.containers.run(image=image_id, remove=True, detach=True,
+                                                        ports={f'{port}/tcp': ('127.0.0.1', None)})
+    try:
+        delay = 0.05
+        deadline = time.monotonic() + PROBE_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                container.reload()
+                if container.status == 'exited':
+                    break
+                bindings = container.ports.get(f'{port}/tcp')
+                if bindings:
+                    appmetadata = urllib.request.urlopen(f'http://127.0.0.1:{bindings[0]["HostPort"]}', timeout=5).read()
+                    return json.loads(appmetadata)
+            except docker.errors.NotFound:
+                # crashed and already removed
+                break
+            except (OSError, HTTPException, ValueError):
+                # not yet listening, or accepted the connection before the server is fully up
+                pass
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+        # TODO (krim @ 7/13/21): should I just use app_config and continue? 
+        raise ConnectionError(f"app \"{app_name}\" is not responding, and galaxy config.xml cannot be generated")
+    finally:
+        try:
+            container.stop()
+        except docker.errors.NotFound:
+            pass
+
+
+def gen_app_config_xml(app_name, config_xml_tree, port, result_cache_size=None):
     command_tag = config_xml_tree.find('command')
-    params_collector = '#set $params = "".join([f"{k}={v}&" for k, v in $runtime_params.items()]) if $runtime_params else ""\n'
-    curl_cmd = CDATA(f"{params_collector}curl -s -X POST -H 'Content-Type: application/json' -d @$input \"{app_name}:{port}?$params\" > $output")
-    command_tag.append(curl_cmd)
+    has_runtime_params = config_xml_tree.find("inputs/section[@name='runtime_params']") is not None
+    cache_namespace = None
+    if result_cache_size:
+        # the build key changes with the app code even when the app version doesn't (e.g., a branch)
+        build_key = read_build_manifest().get(app_name, {}).get('key', '')
+        cache_namespace = f"{app_name}@{config_xml_tree.getroot().get('version')}+{build_key[:12]}"
+    command_tag.append(CDATA(gen_app_command(app_name, port, has_runtime_params, cache_namespace, result_cache_size)))
     try: 
         del command_tag.attrib['interpreter']
     except KeyError as ignored:
         pass
-    config_xml_string = ET.tostring(config_xml_tree.getroot(), 'utf8')
-    reparsed = minidom.parseString(config_xml_string)
-    with open(get_tool_config_xml_fullpath(app_name), 'w', encoding='utf8') as config_xml_file:
-        config_xml_file.write(reparsed.toprettyxml(indent="\t"))
-    return config_xml_tree
+    return write_xml(get_tool_config_xml_fullpath(app_name), config_xml_tree.getroot())
+
+
+def gen_app_command(app_name, port, has_runtime_params=True, cache_namespace=None, cache_size=None):
+    command = [f"python3 '$__tool_directory__/{MMIF_CLIENT_FILENAME}' --url 'http://{app_name}:{port}' --input '$input' --output '$output'"]
+    if cache_namespace is not None:
+        command.append(f"--cache-dir '{RESULT_CACHE_CONTPATH}' --cache-namespace '{cache_namespace}' --cache-size {cache_size}")
+    if has_runtime_params:
+        # galaxy joins lines of a command, and cheetah directives need their own lines
+        command.extend([
+            '#for $k, $v in $runtime_params.items()',
+            "--param '$k=$v'",
+            '#end for',
+        ])
+    return '\n'.join(command)
+
+
+def get_result_cache_size(config):
+    """
+    Returns the maximum size of the result cache in bytes, or None when the result cache is not configured. 
+    """
+    result_cache_config = config.get(RESULT_CACHE)
+    if not result_cache_config:
+        return None
+    if not isinstance(result_cache_config, dict):
+        result_cache_config = {}
+    return parse_size(str(result_cache_config.get('size', DEFAULT_RESULT_CACHE_SIZE)))
+
+
+def parse_size(size):
+    """
+    Parses a size string in docker-compose style (e.g., ``512m``, ``10G``) into bytes. 
+    """
+    units = {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([bkmgt]?)b?\s*', size.lower())
+    if match is None:
+        raise ValueError(f'invalid size: {size}')
+    return int(float(match.group(1)) * units[match.group(2) or 'b'])
+
+
+def install_mmif_client():
+    with open(pjoin(os.path.dirname(os.path.abspath(__file__)), MMIF_CLIENT_FILENAME), encoding='utf8') as client_file:
+        return write_if_changed(pjoin(GALAXY_LOCAL_PATH, 'tools', MMIF_CLIENT_FILENAME), client_file.read())
 
 
 def configyml_to_config_xml_tree(app_name, app_config):
@@ -305,13 +1166,7 @@ def appmetadata_to_config_xml_tree(appmetadata):
     tool_tag = ET.Element('tool')
     
     def escape_to_galaxy_tool_id(s: str):
-        escaped = ""
-        for c in s:
-            if not c.isalpha() and not c.isdigit() and c not in "-_":
-                escaped += "_"
-            else:
-                escaped += c
-        return escaped
+        return ''.join(c if c.isalpha() or c.isdigit() or c in '-_' else '_' for c in s)
                 
     tool_tag.set('id', escape_to_galaxy_tool_id(appmetadata['identifier']))
     tool_tag.set('name', appmetadata['name'])
@@ -394,61 +1249,747 @@ def appmetadata_to_config_xml_tree(appmetadata):
     return ET.ElementTree(tool_tag)
 
 
-def add_to_tool_conf_xml(tool_conf_tree: ET.ElementTree, config_xml_tree: ET.ElementTree, app_name):
-    categories = config_xml_tree.find('categories').text.split(',')
-    tool_tag = ET.Element('tool', {'file': get_tool_config_xml_filename(app_name)})
+def add_to_tool_conf_xml(tool_conf_tree: ET.ElementTree, config_xml_tree: ET.ElementTree, app_name, sections=None, tool_sections=None):
+    """
+    Adds the tool of an app to sections of its categories. ``sections`` (an index of sections by id) and 
+    ``tool_sections`` (an index of section ids by tool file) are from ``index_tool_conf_sections``, to keep 
+    using them across apps, and they're updated with changes, so that each app only costs its categories. 
+    """
+    if sections is None or tool_sections is None:
+        sections, tool_sections = index_tool_conf_sections(tool_conf_tree)
+    tool_file = get_tool_config_xml_filename(app_name)
+    categories = [category for category in config_xml_tree.find('categories').text.split(',') if category]
+    section_ids = tool_sections.setdefault(tool_file, set())
+    # existing entries are updated in place, so that re-running doesn't add duplicates nor reorder tools
+    for section_id in section_ids - set(categories):
+        section = sections[section_id]
+        for tool_tag in section.findall('tool'):
+            if tool_tag.get('file') == tool_file:
+                section.remove(tool_tag)
+        section_ids.discard(section_id)
     for category in categories:
-        category_exists = False
-        for section in tool_conf_tree.findall('section'):
-            if section.attrib['id'] == category:
-                section.append(tool_tag)
-                category_exists = True
-        if not category_exists:
-            section_tag = ET.Element('section', {'id': category, 'name': f"{category} Apps"})
-            section_tag.append(tool_tag)
-            tool_conf_tree.getroot().append(section_tag)
-
-
-def gen_display_app_xml(consumer_name, port, description):
+        if category in section_ids:
+            continue
+        section = sections.get(category)
+        if section is None:
+            section = sections[category] = ET.SubElement(tool_conf_tree.getroot(), 'section', {'id': category, 'name': f"{category} Apps"})
+        ET.SubElement(section, 'tool', {'file': tool_file})
+        section_ids.add(category)
+
+
+def index_tool_conf_sections(tool_conf_tree: ET.ElementTree):
+    """
+    Returns an index of sections by id, and an index of ids of the sections by the files of their tools. 
+    """
+    sections = {}
+    tool_sections = {}
+    for section in tool_conf_tree.findall('section'):
+        section_id = section.get('id')
+        if section_id in sections:
+            continue
+        sections[section_id] = section
+        for tool_tag in section.iterfind('tool'):
+            tool_sections.setdefault(tool_tag.get('file'), set()).add(section_id)
+    return sections, tool_sections
+
+
+def prune_tool_conf_xml(tool_conf_tree: ET.ElementTree, app_names):
+    """
+    Removes generated tools of apps other than the given ones (i.e., removed or disabled apps). 
+    """
+    keep = {get_tool_config_xml_filename(app_name) for app_name in app_names}
+    generated_prefix = get_docker_image_name(APP_PREFIX)
+    for section in tool_conf_tree.findall('section'):
+        for tool_tag in section.findall('tool'):
+            tool_file = tool_tag.get('file', '')
+            if tool_file.startswith(generated_prefix) and tool_file not in keep:
+                section.remove(tool_tag)
+
+
+def remove_empty_sections(tool_conf_tree: ET.ElementTree):
+    # only the sections made by `add_to_tool_conf_xml`
+    for section in tool_conf_tree.findall('section'):
+        if len(section) == 0 and section.get('name') == f"{section.get('id')} Apps":
+            tool_conf_tree.getroot().remove(section)
+
+
+def gen_display_app_xml(consumer_name, port, description, direct_access=False):
+    """
+    Generates a display application that opens a MMIF dataset in the consumer. The consumer downloads the 
+    dataset from Galaxy by the ``file`` URL, and with ``direct_access``, the display URL also has ``path``, 
+    the path of the dataset file in the Galaxy volume, for the consumer to read the file directly instead. 
+    """
     display_tag = ET.Element('display', {'id': consumer_name, 'version': '1.0.0', 'name': description})
     link_tag = ET.SubElement(display_tag, 'link', {'id': 'open', 'name': 'open'})
     url_tag = ET.SubElement(link_tag, 'url')
     url_tag.text = f'http://{HOSTNAME}:{port}/display?file=${{qp("/".join($txt_file.url.split("/")[:2] + ["{GALAXY_CONTNAME}:{GALAXY_CONTPORT}"] + $txt_file.url.split("/")[3:]))}}'
+    if direct_access:
+        # consumers that don't know `path` keep using `file`
+        url_tag.text += '&path=${qp($txt_file.file_name)}'
     param_tag = ET.SubElement(link_tag, 'param', {'type': 'data', 'name': 'txt_file', 'url': 'galaxy.txt'})
-    ET.ElementTree(display_tag).write(pjoin(get_display_app_xml_fullpath(consumer_name)), encoding='utf-8')
+    return write_xml(get_display_app_xml_fullpath(consumer_name), display_tag)
 
 
 def add_to_datatypes_conf_xml(datatypes_conf_tree: ET.ElementTree, consumer_name):
-    display_tag = ET.Element('display', {'file': get_display_app_xml_filename(consumer_name)})
+    display_file = get_display_app_xml_filename(consumer_name)
+    display_tag = ET.Element('display', {'file': display_file})
     for dt in datatypes_conf_tree.find('registration').findall('datatype'):
-        if dt.attrib['extension'] == 'json':
+        if dt.attrib['extension'] == 'json' and not any(d.get('file') == display_file for d in dt.findall('display')):
             dt.append(display_tag)
 
 
-def gen_db_loc_files(host_data_path):
-    for mtype in ['text', 'video', 'image', 'audio']:
+def prune_datatypes_conf_xml(datatypes_conf_tree: ET.ElementTree, consumer_names):
+    """
+    Removes generated display applications of consumers other than the given ones. 
+    """
+    keep = {get_display_app_xml_filename(consumer_name) for consumer_name in consumer_names}
+    generated_prefix = get_docker_image_name(CONSUMER_PREFIX)
+    for dt in datatypes_conf_tree.find('registration').findall('datatype'):
+        for display_tag in dt.findall('display'):
+            display_file = display_tag.get('file', '')
+            if display_file.startswith(generated_prefix) and display_file not in keep:
+                dt.remove(display_tag)
+
+
+def remove_galaxy_configs(name):
+    """
+    Deletes the generated tool or display application config file of an app or a consumer. 
+    Returns whether the file existed. 
+    """
+    config_path = get_tool_config_xml_fullpath(name) if name.startswith(APP_PREFIX) else get_display_app_xml_fullpath(name)
+    try:
+        os.remove(config_path)
+    except OSError:
+        return False
+    return True
+
+
+def get_state_entry(name, entry_config, host_port):
+    build = read_build_manifest().get(name, {})
+    return {'config': entry_config, 'host_port': host_port, 'key': build.get('key'), 'image': build.get('image')}
+
+
+def write_state(config):
+    """
+    Records the configuration each app and consumer was last generated from, along with its image. 
+    """
+    state = {'global': {key: config.get(key) for key in (ARCHIVE_PATH, ARCHIVE_EXTENSIONS, RESULT_CACHE, RESOURCES)}, APPS: {}, CONSUMERS: {}}
+    for host_port, (app_name, app_config) in enumerate(config[APPS].items(), 8001):
+        if app_config['enabled']:
+            state[APPS][f'{APP_PREFIX}{app_name}'] = get_state_entry(f'{APP_PREFIX}{app_name}', app_config, host_port)
+    for host_port, (consumer_name, consumer_config) in enumerate((config[CONSUMERS] or {}).items(), 9001):
+        if consumer_config['enabled']:
+            state[CONSUMERS][f'{CONSUMER_PREFIX}{consumer_name}'] = get_state_entry(f'{CONSUMER_PREFIX}{consumer_name}', consumer_config, host_port)
+    write_if_changed(STATE_PATH, json.dumps(state, indent=2, sort_keys=True) + '\n')
+
+
+def read_state():
+    try:
+        with open(STATE_PATH) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return None
+
+
+def plan_changes(config, state):
+    """
+    Compares the configuration to the state of the last build, and returns a dict with 
+    ``targets``, prefixed names of apps and consumers to (re-)build with reasons as values, 
+    ``removed``, prefixed names of apps and consumers to remove, and 
+    ``global``, names of changed top-level configuration keys. 
+    """
+    if state is None or not os.path.exists(GALAXY_LOCAL_PATH):
+        state = {'global': {}, APPS: {}, CONSUMERS: {}}
+    plan = {'targets': {}, 'removed': [], 'global': []}
+    plan['global'] = [key for key in (ARCHIVE_PATH, ARCHIVE_EXTENSIONS, RESULT_CACHE, RESOURCES) if config.get(key) != state['global'].get(key)]
+    for section, prefix, port_start, config_path_getter in ((APPS, APP_PREFIX, 8001, get_tool_config_xml_fullpath),
+                                                            (CONSUMERS, CONSUMER_PREFIX, 9001, get_display_app_xml_fullpath)):
+        entries = config[section] or {}
+        enabled = set()
+        for host_port, (name, entry_config) in enumerate(entries.items(), port_start):
+            if not entry_config['enabled']:
+                continue
+            name = f'{prefix}{name}'
+            enabled.add(name)
+            recorded = state[section].get(name)
+            reasons = []
+            if recorded is None:
+                reasons.append('added')
+            else:
+                reasons.extend(f'{key} changed' for key in sorted(set(entry_config) | set(recorded['config']))
+                               if entry_config.get(key) != recorded['config'].get(key))
+                if section == CONSUMERS and host_port != recorded['host_port']:
+                    # the host port is in the display URL
+                    reasons.append('port changed')
+                if section == APPS and RESULT_CACHE in plan['global']:
+                    reasons.append('result cache changed')
+                if not os.path.exists(config_path_getter(name)):
+                    reasons.append('galaxy config missing')
+                if not docker_engine.images.list(name=get_docker_image_name(name)):
+                    reasons.append('image missing')
+            if reasons:
+                plan['targets'][name] = reasons
+        plan['removed'].extend(sorted(name for name in state[section] if name not in enabled))
+    return plan
+
+
+def print_plan(plan):
+    if plan['global']:
+        print(f"~ configuration: {', '.join(plan['global'])} changed")
+    for name, reasons in plan['targets'].items():
+        print(f"{'+' if reasons == ['added'] else '~'} {name}: {', '.join(reasons)}")
+    for name in plan['removed']:
+        print(f"- {name}: removed")
+    if not (plan['global'] or plan['targets'] or plan['removed']):
+        print("No changes in the configuration.")
+
+
+def gen_db_loc_files(host_data_path, extensions=None):
+    """
+    Generates a data table (``.loc`` file) for each media type, listing all files under the media type 
+    directory recursively. ``extensions`` optionally maps media types to lists of file extensions to list. 
+    Returns whether any of the files has changed. 
+    """
+    if not extensions:
+        extensions = {}
+    changed = False
+    for mtype in MEDIA_TYPES:
         type_path = pjoin(host_data_path, mtype)
         if os.path.exists(type_path) and os.path.isdir(type_path):
-            with open(pjoin(GALAXY_LOCAL_PATH, 'tool-data', f'{mtype}db.loc'), 'w') as loc_file:
-                for f_name in os.listdir(type_path):
-                    if os.path.isfile(pjoin(type_path, f_name)) and not f_name.startswith('.'):
-                        loc_file.write(f'{f_name}\t{pjoin(CONTAINER_DATA_PATH, mtype, f_name)}\n')
+            with tracer.phase(mtype, 'archive indexing'):
+                index = update_archive_index(type_path, pjoin(ARCHIVE_INDEX_PATH, f'{mtype}.json'))
+            mtype_exts = tuple(f'.{ext.lstrip(".").lower()}' for ext in extensions.get(mtype, []))
+            loc_lines = []
+            for f_path in sorted(iter_archive_index(index)):
+                if mtype_exts and not f_path.lower().endswith(mtype_exts):
+                    continue
+                if '\t' in f_path or '\n' in f_path:
+                    # can't be represented in a tab-separated .loc file
+                    continue
+                loc_lines.append(f'{f_path}\t{posixpath.join(CONTAINER_DATA_PATH, mtype, f_path)}\n')
+            with tracer.phase(f'{mtype}db.loc', 'loc generation', files=len(loc_lines)):
+                changed |= write_if_changed(pjoin(GALAXY_LOCAL_PATH, 'tool-data', f'{mtype}db.loc'), ''.join(loc_lines))
+    return changed
+
+
+def update_archive_index(root, index_path):
+    """
+    Updates the persisted index of all (non-hidden) files under ``root``, and returns the index. 
+    
+    The index maps each directory (relative to ``root``) to its modification time, subdirectory names, 
+    and file names. Since adding, removing, or renaming an entry always changes the modification time of 
+    the containing directory, only directories with changed modification times are listed again, and the 
+    rest are only stat'ed. Sizes and modification times of files are not recorded, as data tables only 
+    list paths, and keeping them up to date would take a stat of every file (files modified in place 
+    don't change their directories). 
+    """
+    try:
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        if index.get('version') != ARCHIVE_INDEX_VERSION or index['root'] != os.path.abspath(root):
+            raise ValueError
+        old_dirs = index['dirs']
+    except (OSError, ValueError, KeyError):
+        old_dirs = {}
+    # directories modified just before the scan can be modified again within the timestamp granularity
+    trust_before = time.time_ns() - 2 * 10 ** 9
+    new_dirs = {}
+    visited = set()
+    pending = ['']
+    while pending:
+        rel_dir = pending.pop()
+        try:
+            dir_stat = os.stat(pjoin(root, rel_dir))
+        except OSError:
+            continue
+        if (dir_stat.st_dev, dir_stat.st_ino) in visited:
+            # a symlink loop
+            continue
+        visited.add((dir_stat.st_dev, dir_stat.st_ino))
+        entry = old_dirs.get(rel_dir)
+        if entry is None or entry['mtime'] != dir_stat.st_mtime_ns:
+            entry = scan_archive_dir(pjoin(root, rel_dir))
+            entry['mtime'] = dir_stat.st_mtime_ns if dir_stat.st_mtime_ns < trust_before else None
+        new_dirs[rel_dir] = entry
+        pending.extend(posixpath.join(rel_dir, d) for d in entry['dirs'])
+    index = {'version': ARCHIVE_INDEX_VERSION, 'root': os.path.abspath(root), 'dirs': new_dirs}
+    if new_dirs != old_dirs:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        write_atomic(index_path, json.dumps(index, separators=(',', ':')))
+    return index
+
+
+def scan_archive_dir(dir_path):
+    files = []
+    dirs = []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+            except OSError:
+                # e.g. a broken symlink
+                pass
+    return {'dirs': sorted(dirs), 'files': sorted(files)}
+
+
+def iter_archive_index(index):
+    for rel_dir, entry in index['dirs'].items():
+        for f_name in entry['files']:
+            yield posixpath.join(rel_dir, f_name)
 
 
 def download_app(app_name, app_config):
+    if app_config['enabled'] and os.path.exists(app_name) and is_stale_local_copy(app_name, app_config):
+        print(f"Source of {app_name} has changed in the configuration, downloading again...")
+        remove_local_copy(app_name)
     if app_config['enabled'] and not os.path.exists(app_name):
-        if 'branch' in app_config:
-            more_params = ['--branch', app_config['branch']]
-        else:
-            more_params = []
-        download(app_config['repository'], app_name, more_params)
+        download(app_config['repository'], app_name, app_config.get('branch'))
+        update_build_manifest(app_name, repository=app_config['repository'], branch=app_config.get('branch'))
+
 
+def is_stale_local_copy(app_name, app_config):
+    """
+    Checks if an existing local copy was downloaded from a different repository or branch than the configured one. 
+    Local copies that aren't recorded in the build manifest are never considered stale. 
+    """
+    recorded = read_build_manifest().get(app_name, {})
+    if 'repository' not in recorded or DEVELOP:
+        return False
+    return (recorded['repository'], recorded['branch']) != (app_config['repository'], app_config.get('branch'))
 
-def download(repo_url, clone_dir, more_params=[]):
+
+def download(repo_url, clone_dir, branch=None):
     if DEVELOP:
         os.symlink(pjoin('..', clone_dir), clone_dir)
-    else:
-        subprocess.run(['git', 'clone', '--depth', '1'] + more_params + [ repo_url, clone_dir], check=True)
+        return
+    with tracer.phase(clone_dir, 'clone', repository=repo_url, branch=branch):
+        mirror_path, commit = update_git_mirror(repo_url, branch)
+        # checked out aside and moved into place when complete, so that a failure never leaves a partial copy
+        tmp_dir = f'{clone_dir}.{threading.get_ident()}.tmp'
+        remove_local_copy(tmp_dir)
+        try:
+            subprocess.run(['git', 'init', '--quiet', tmp_dir], check=True)
+            # objects are borrowed from the mirror (as `clone --shared` does), so a local copy costs only a checkout
+            with open(pjoin(tmp_dir, '.git', 'objects', 'info', 'alternates'), 'w') as alternates_file:
+                alternates_file.write(pjoin(os.path.abspath(mirror_path), 'objects') + '\n')
+            subprocess.run(['git', '-C', tmp_dir, 'remote', 'add', 'origin', repo_url], check=True)
+            subprocess.run(['git', '-C', tmp_dir, 'checkout', '--quiet', '--detach', commit], check=True)
+            os.rename(tmp_dir, clone_dir)
+        finally:
+            remove_local_copy(tmp_dir)
+
+
+def get_git_mirror_path(repo_url):
+    repo_name = re.sub(r'[^A-Za-z0-9._-]', '_', repo_url.rstrip('/').split('/')[-1])
+    if repo_name.endswith('.git'):
+        repo_name = repo_name[:-len('.git')]
+    return pjoin(GIT_CACHE_PATH, f'{repo_name}-{hashlib.sha1(repo_url.encode("utf8")).hexdigest()[:10]}.git')
+
+
+def update_git_mirror(repo_url, branch=None):
+    """
+    Fetches only the given branch or tag (or the remote HEAD, when not given) of a repository into its local 
+    bare mirror, and returns the path to the mirror and the fetched commit. When the remote is not reachable, 
+    the commit fetched last time is used, if any. 
+    """
+    mirror_path = get_git_mirror_path(repo_url)
+    ref = branch if branch else 'HEAD'
+    mirror_ref = f'refs/appliance/{ref}'
+    with _git_mirror_locks_lock:
+        mirror_lock = _git_mirror_locks.setdefault(mirror_path, threading.Lock())
+    with mirror_lock:
+        if not os.path.exists(mirror_path):
+            subprocess.run(['git', 'init', '--quiet', '--bare', mirror_path], check=True)
+        fetch = subprocess.run(['git', '-C', mirror_path, 'fetch', '--quiet', '--no-tags', repo_url, f'+{ref}:{mirror_ref}'])
+        resolved = subprocess.run(['git', '-C', mirror_path, 'rev-parse', '--verify', '--quiet', f'{mirror_ref}^{{commit}}'],
+                                  stdout=subprocess.PIPE, universal_newlines=True)
+    if resolved.returncode != 0:
+        raise subprocess.CalledProcessError(fetch.returncode, fetch.args)
+    if fetch.returncode != 0:
+        print(f"Cannot fetch {ref} from {repo_url}, using the cached copy in {mirror_path}")
+    return mirror_path, resolved.stdout.strip()
+
+
+def process_archive(config, media_type, chain, output_dir, workers=DEFAULT_PROCESS_WORKERS, host='localhost'):
+    """
+    Runs every file of a media type in the archive through a chain of apps of a running appliance, 
+    and writes the output MMIF files under ``output_dir``, mirroring the archive directory structure. 
+    Finished files are recorded in a journal in ``output_dir``, so that an interrupted run can be 
+    resumed by running the same command again. 
+    """
+    # only needed here, so that other commands work with a copy of this script alone
+    from mmif_client import MMIFClient
+    app_urls = []
+    app_slots = []
+    for app_name in chain:
+        if app_name not in config[APPS] or not config[APPS][app_name]['enabled']:
+            raise ValueError(f'app "{app_name}" is not enabled in the configuration')
+        app_urls.append(f'http://{host}:{get_app_host_port(config[APPS], app_name)}')
+        # a slow app in the middle of the chain shouldn't be flooded by workers done with faster apps
+        app_config = config[APPS][app_name]
+        app_slots.append(threading.BoundedSemaphore(app_config.get('concurrency', app_config.get('replicas', 1))))
+
+    type_path = pjoin(config[ARCHIVE_PATH], media_type)
+    index = update_archive_index(type_path, pjoin(ARCHIVE_INDEX_PATH, f'{media_type}.json'))
+    extensions = tuple(f'.{ext.lstrip(".").lower()}' for ext in (config.get(ARCHIVE_EXTENSIONS) or {}).get(media_type, []))
+    os.makedirs(output_dir, exist_ok=True)
+    journal_path = pjoin(output_dir, PROCESS_JOURNAL_FILENAME)
+    done = read_process_journal(journal_path)
+    pending = iter([f_path for f_path in sorted(iter_archive_index(index))
+                    if f_path not in done and (not extensions or f_path.lower().endswith(extensions))])
+    pending_lock = threading.Lock()
+    journal_lock = threading.Lock()
+    counts = {'done': 0, 'failed': 0}
+    print(f"Processing {media_type} files with {' -> '.join(chain)}, skipping {len(done)} files already done")
+
+    def work():
+        clients = [MMIFClient(url) for url in app_urls]
+        try:
+            while True:
+                with pending_lock:
+                    f_path = next(pending, None)
+                if f_path is None:
+                    return
+                try:
+                    process_archive_file(media_type, f_path, output_dir, clients, app_slots)
+                    record = {'file': f_path, 'status': 'done'}
+                except Exception as e:
+                    record = {'file': f_path, 'status': 'failed', 'error': str(e)}
+                with journal_lock:
+                    with open(journal_path, 'a') as journal_file:
+                        journal_file.write(json.dumps(record) + '\n')
+                    counts[record['status']] += 1
+                    if record['status'] == 'failed':
+                        print(f"Failed: {f_path}: {record['error']}")
+                    finished = counts['done'] + counts['failed']
+                    if finished % 100 == 0:
+                        print(f"{finished} files processed ({counts['failed']} failed)")
+        finally:
+            for client in clients:
+                client.close()
+
+    # daemon threads don't block ctrl-c, and the journal has all files finished by then
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f"Done: {counts['done']} files processed, {counts['failed']} failed, {len(done)} skipped")
+    return counts
+
+
+def get_app_host_port(apps_config, app_name):
+    # same as the order `process_all_apps` assigns host ports
+    return list(apps_config.keys()).index(app_name) + 8001
+
+
+def read_process_journal(journal_path):
+    done = set()
+    try:
+        with open(journal_path) as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut by an interruption
+                    continue
+                if record['status'] == 'done':
+                    done.add(record['file'])
+                else:
+                    done.discard(record['file'])
+    except OSError:
+        pass
+    return done
+
+
+def process_archive_file(media_type, f_path, output_dir, clients, app_slots):
+    output_path = pjoin(output_dir, f'{f_path}.mmif')
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    stage_path = f'{output_path}.{threading.get_ident()}'
+    try:
+        with open(stage_path, 'w') as stage_file:
+            json.dump(gen_source_mmif(media_type, f_path), stage_file)
+        for client, slot in zip(clients, app_slots):
+            with slot:
+                client.annotate(stage_path, stage_path)
+        os.replace(stage_path, output_path)
+    finally:
+        if os.path.exists(stage_path):
+            os.remove(stage_path)
+
+
+def gen_source_mmif(media_type, f_path):
+    """
+    Generates a MMIF with a single document pointing to a file in the archive, as mounted in app containers. 
+    """
+    location = posixpath.join(CONTAINER_DATA_PATH, media_type, f_path)
+    properties = {'id': 'd1', 'location': f'file://{location}'}
+    mime = mimetypes.guess_type(f_path)[0]
+    if mime:
+        properties['mime'] = mime
+    return {
+        'metadata': {'mmif': f'http://mmif.clams.ai/{MMIF_VERSION}'},
+        'documents': [{
+            '@type': f'http://mmif.clams.ai/{MMIF_VERSION}/vocabulary/{DOCUMENT_TYPES[media_type]}',
+            'properties': properties,
+        }],
+        'views': [],
+    }
+
+
+def start_appliance(timeout=STARTUP_TIMEOUT):
+    """
+    Starts the appliance generated in the current directory with ``docker-compose``, and reports when each 
+    service becomes ready, i.e., healthy, or serving HTTP when it has no healthcheck (Galaxy). 
+    Returns whether all services became ready within ``timeout`` seconds. 
+    """
+    with open('docker-compose.yml') as compose_file:
+        services = yaml.safe_load(compose_file)['services']
+    start = time.monotonic()
+    # in the format of `State.StartedAt` of containers, truncated to seconds
+    started_at = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    # `up` blocks until dependencies of galaxy are healthy, so readiness is watched alongside
+    compose_proc = subprocess.Popen(['docker-compose', 'up', '-d'])
+    pending = dict(services)
+    failed = []
+    compose_status = None
+    while pending and time.monotonic() - start < timeout:
+        compose_status = compose_proc.poll()
+        if compose_status:
+            break
+        # containers left from an earlier run are ignored until compose is done recreating or starting them
+        since = started_at if compose_status is None else None
+        for service_name, service_def in list(pending.items()):
+            status = get_service_status(service_def, since)
+            if status is None:
+                continue
+            if status == 'ready':
+                print(f"{service_name} is ready ({time.monotonic() - start:.1f}s)")
+            else:
+                print(f"{service_name} failed to start: {status}")
+                failed.append(service_name)
+            del pending[service_name]
+        if pending:
+            time.sleep(1)
+    if not compose_status:
+        for service_name in pending:
+            print(f"{service_name} is not ready after {timeout}s")
+    try:
+        compose_status = compose_proc.wait(timeout=max(timeout - (time.monotonic() - start), 0))
+    except subprocess.TimeoutExpired:
+        # e.g., still waiting for a dependency of galaxy that never becomes healthy
+        compose_proc.terminate()
+        compose_proc.wait()
+        print(f"docker-compose is not done after {timeout}s")
+        return False
+    if compose_status != 0:
+        print("docker-compose failed to start all services")
+        return False
+    if not pending and not failed:
+        print(f"The appliance is ready ({time.monotonic() - start:.1f}s), Galaxy is at http://{HOSTNAME}:{PRIMARY_HOSTPORT}")
+    return not pending and not failed
+
+
+def get_service_status(service_def, since=None):
+    """
+    Returns 'ready' for a ready service, None for a service that is still starting, or the reason it failed. 
+    A container that was last started before ``since`` (a UTC timestamp in ``%Y-%m-%dT%H:%M:%S``) is 
+    considered still starting. 
+    """
+    try:
+        state = docker_engine.containers.get(service_def['container_name']).attrs['State']
+    except docker.errors.NotFound:
+        return None
+    if since is not None and state['StartedAt'][:19] < since:
+        return None
+    if state['Status'] in ('exited', 'dead'):
+        return f"exited with {state.get('ExitCode')}"
+    if 'Health' in state:
+        health = state['Health']['Status']
+        return {'healthy': 'ready', 'unhealthy': 'unhealthy'}.get(health)
+    if state['Status'] != 'running':
+        return None
+    if not service_def.get('ports'):
+        return 'ready'
+    host_port = service_def['ports'][0].split(':')[0]
+    try:
+        urllib.request.urlopen(f'http://localhost:{host_port}/', timeout=5)
+    except urllib.error.HTTPError as e:
+        # galaxy's proxy responds with 502 until galaxy itself is up
+        return 'ready' if e.code < 500 else None
+    except (OSError, HTTPException):
+        return None
+    return 'ready'
+
+
+def bundle_appliance(bundle_path):
+    """
+    Writes images of all services of the generated appliance (including lazy apps), and the generated files 
+    to run them, into a single tar file, along with a manifest of sha256 checksums of its contents. 
+    Images are saved together, so that layers shared by images are stored once. 
+    """
+    with open('docker-compose.yml') as compose_file:
+        services = yaml.safe_load(compose_file)['services']
+    images = {service_def['image'] for service_def in services.values()}
+    if os.path.isdir(LAZY_PROXY_CONF_PATH):
+        for conf_filename in os.listdir(LAZY_PROXY_CONF_PATH):
+            if conf_filename.endswith('.json'):
+                with open(pjoin(LAZY_PROXY_CONF_PATH, conf_filename)) as conf_file:
+                    images.add(json.load(conf_file)['create']['Image'])
+    images = sorted(images)
+    for image_name in images:
+        try:
+            docker_engine.images.get(image_name)
+        except docker.errors.ImageNotFound:
+            # stock images (load balancers, proxies) are only pulled when the appliance first starts
+            print(f"Pulling {image_name}...")
+            docker_engine.images.pull(image_name)
+    files = get_bundle_files()
+    images_path = f'{bundle_path}.images.tmp'
+    try:
+        print(f"Saving {len(images)} images: {', '.join(images)}")
+        save_proc = subprocess.Popen(['docker', 'save', *images], stdout=subprocess.PIPE)
+        with gzip.open(images_path, 'wb', compresslevel=BUNDLE_COMPRESSLEVEL) as images_file:
+            shutil.copyfileobj(save_proc.stdout, images_file, 1 << 20)
+        if save_proc.wait() != 0:
+            raise subprocess.CalledProcessError(save_proc.returncode, save_proc.args)
+        manifest = {
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'images': images,
+            'files': {BUNDLE_IMAGES: file_sha256(images_path)},
+        }
+        manifest['files'].update((f_path, file_sha256(f_path)) for f_path in files)
+        manifest_bytes = json.dumps(manifest, indent=2).encode('utf8')
+        with tarfile.open(bundle_path, 'w') as bundle:
+            manifest_info = tarfile.TarInfo(BUNDLE_MANIFEST)
+            manifest_info.size = len(manifest_bytes)
+            manifest_info.mtime = int(time.time())
+            bundle.addfile(manifest_info, io.BytesIO(manifest_bytes))
+            bundle.add(images_path, arcname=BUNDLE_IMAGES)
+            for f_path in files:
+                bundle.add(f_path, arcname=f_path)
+    finally:
+        if os.path.exists(images_path):
+            os.remove(images_path)
+    print(f"Bundled the appliance into {bundle_path} ({os.path.getsize(bundle_path) / 1024 ** 3:.2f}GB)")
+
+
+def restore_appliance(bundle_path, timeout=STARTUP_TIMEOUT, force=False):
+    """
+    Verifies checksums of a bundle made by ``bundle_appliance``, loads its images, writes its files into 
+    the current directory, and starts the appliance. Returns whether the appliance became ready. 
+    An appliance already in the current directory is only overwritten with ``force``. 
+    """
+    existing = [f_path for f_path in ('config.yaml', 'docker-compose.yml', STATE_PATH) if os.path.exists(f_path)]
+    if existing and not force:
+        raise FileExistsError(f'{", ".join(existing)} already in the current directory, use --force to overwrite')
+    with tarfile.open(bundle_path) as bundle:
+        manifest = json.load(bundle.extractfile(BUNDLE_MANIFEST))
+        for f_path in manifest['files']:
+            if os.path.isabs(f_path) or '..' in f_path.split('/'):
+                raise ValueError(f'invalid path in bundle: {f_path}')
+        # everything is checked before anything is loaded or written
+        print(f"Verifying {bundle_path}...")
+        verified = set()
+        for member in bundle:
+            if member.name == BUNDLE_MANIFEST:
+                continue
+            if not member.isfile() or member.name not in manifest['files']:
+                raise ValueError(f'unexpected entry in bundle: {member.name}')
+            if stream_sha256(bundle.extractfile(member)) != manifest['files'][member.name]:
+                raise ValueError(f'checksum mismatch in bundle: {member.name}')
+            verified.add(member.name)
+        missing = set(manifest['files']) - verified
+        if missing:
+            raise ValueError(f'missing in bundle: {", ".join(sorted(missing))}')
+        print(f"Loading {len(manifest['images'])} images: {', '.join(manifest['images'])}")
+        # `docker load` takes gzipped archives as is
+        load_proc = subprocess.Popen(['docker', 'load', '--quiet'], stdin=subprocess.PIPE)
+        with load_proc.stdin:
+            shutil.copyfileobj(bundle.extractfile(BUNDLE_IMAGES), load_proc.stdin, 1 << 20)
+        if load_proc.wait() != 0:
+            raise subprocess.CalledProcessError(load_proc.returncode, load_proc.args)
+        for f_path in manifest['files']:
+            if f_path == BUNDLE_IMAGES:
+                continue
+            if os.path.dirname(f_path):
+                os.makedirs(os.path.dirname(f_path), exist_ok=True)
+            with open(f_path, 'wb') as out_file:
+                shutil.copyfileobj(bundle.extractfile(f_path), out_file)
+    with open('docker-compose.yml') as compose_file:
+        compose = yaml.safe_load(compose_file)
+    for volumename, volume_def in compose.get('volumes', {}).items():
+        if volume_def and volume_def.get('external'):
+            try:
+                docker_engine.volumes.get(volumename)
+            except docker.errors.NotFound:
+                docker_engine.volumes.create(volumename)
+    check_restored_host(compose)
+    return start_appliance(timeout)
+
+
+def check_restored_host(compose):
+    """
+    Warns about settings of the restored appliance that don't fit this host: bind mount sources that don't 
+    exist, and cpusets with cores the docker host doesn't have. Both compose services and lazy apps 
+    (started by their proxies, outside of compose) are checked. 
+    """
+    containers = {}
+    for service_name, service_def in compose['services'].items():
+        containers[service_name] = (service_def.get('volumes', []), service_def.get('cpuset'))
+    if os.path.isdir(LAZY_PROXY_CONF_PATH):
+        for conf_filename in sorted(os.listdir(LAZY_PROXY_CONF_PATH)):
+            if conf_filename.endswith('.json'):
+                with open(pjoin(LAZY_PROXY_CONF_PATH, conf_filename)) as conf_file:
+                    lazy_config = json.load(conf_file)
+                host_config = lazy_config['create'].get('HostConfig', {})
+                containers[lazy_config['container']] = (host_config.get('Binds', []), host_config.get('CpusetCpus'))
+    n_cores = docker_engine.info()['NCPU']
+    for cont_name, (volumes, cpuset) in containers.items():
+        for volume in volumes:
+            source = volume.split(':')[0]
+            if source.startswith(('/', '~')) and not os.path.exists(os.path.expanduser(source)):
+                # e.g., the archive is at a different path on this host
+                print(f"Warning: {source} mounted to {cont_name} doesn't exist on this host")
+        if cpuset and max(parse_cpuset(str(cpuset))) >= n_cores:
+            # e.g., the bundle was made on a larger machine with `resources`
+            print(f"Warning: cpuset {cpuset} of {cont_name} names cores the docker host doesn't have (it has {n_cores})")
+
+
+def get_bundle_files():
+    files = []
+    for path in BUNDLE_FILES:
+        if os.path.isdir(path):
+            for root, _, f_names in os.walk(path):
+                files.extend(pjoin(root, f_name) for f_name in sorted(f_names))
+        elif os.path.exists(path):
+            files.append(path)
+    return files
+
+
+def file_sha256(f_path):
+    with open(f_path, 'rb') as f:
+        return stream_sha256(f)
+
+
+def stream_sha256(f):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def positive_int(value):
+    # for argparse, which reports a ValueError as an invalid value
+    number = int(value)
+    if number < 1:
+        raise ValueError(f'must be at least 1: {value}')
+    return number
 
 
 def docker_run(image_name, container_name):
@@ -475,13 +2016,151 @@ if __name__ == '__main__':
     parser.add_argument(
         '-f', '--force-rebuild',
         action='store_true',
-        help='Delete existing CLAMS Apps and Galaxy. Then download all and re-build docker images.'
+        help='Delete existing CLAMS Apps and Galaxy. Then download all again and re-build docker images whose build inputs have changed.'
+    )
+    parser.add_argument(
+        '--git-cache',
+        default=GIT_CACHE_PATH,
+        action='store',
+        help=f'Directory to keep local mirrors of git repositories of Galaxy, apps, and consumers. (default: {GIT_CACHE_PATH})'
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Build all docker images from scratch, without using build caches.'
+    )
+    parser.add_argument(
+        '--trace',
+        default=None,
+        action='store',
+        metavar='TRACE_FILE',
+        help='Write durations of all build phases to TRACE_FILE in Chrome trace format (to open with chrome://tracing or ui.perfetto.dev), and a summary to a .summary.json file next to it.'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        default=DEFAULT_JOBS,
+        type=positive_int,
+        action='store',
+        help=f'Number of apps and consumers to download, build, and probe at the same time. (default: {DEFAULT_JOBS})'
+    )
+    subparsers = parser.add_subparsers(dest='command', title='commands', description='Without a command, the appliance is built.')
+    process_parser = subparsers.add_parser(
+        'process',
+        help='Run a chain of apps of a running appliance over all files of a media type in the archive, outside of Galaxy.'
+    )
+    process_parser.add_argument(
+        'media_type',
+        choices=MEDIA_TYPES,
+        help='Media type subdirectory of the archive to process.'
+    )
+    process_parser.add_argument(
+        'apps',
+        nargs='+',
+        help='Names of enabled apps in the configuration, in the order to run.'
+    )
+    process_parser.add_argument(
+        '-o', '--output',
+        required=True,
+        action='store',
+        help='Directory to write output MMIF files. Re-running with the same directory resumes an interrupted run.'
+    )
+    process_parser.add_argument(
+        '-w', '--workers',
+        default=DEFAULT_PROCESS_WORKERS,
+        type=positive_int,
+        action='store',
+        help=f'Number of files to process at the same time. Concurrent requests to each app are limited by `concurrency` in the app configuration. (default: {DEFAULT_PROCESS_WORKERS})'
+    )
+    process_parser.add_argument(
+        '--host',
+        default='localhost',
+        action='store',
+        help='Host name where the appliance is running. (default: localhost)'
+    )
+    up_parser = subparsers.add_parser(
+        'up',
+        help='Start the generated appliance in the background, and report when each service becomes ready.'
+    )
+    up_parser.add_argument(
+        '--timeout',
+        default=STARTUP_TIMEOUT,
+        type=int,
+        action='store',
+        help=f'Seconds to wait for all services to become ready. (default: {STARTUP_TIMEOUT})'
+    )
+    bundle_parser = subparsers.add_parser(
+        'bundle',
+        help='Write images and generated files of the built appliance into a single file, to restore on another machine without building.'
+    )
+    bundle_parser.add_argument(
+        'bundle_file',
+        help='Path to write the bundle (a tar file).'
+    )
+    restore_parser = subparsers.add_parser(
+        'restore',
+        help='Verify and load a bundle made by `bundle` command into the current directory, and start the appliance.'
+    )
+    restore_parser.add_argument(
+        'bundle_file',
+        help='Path to the bundle.'
+    )
+    restore_parser.add_argument(
+        '--timeout',
+        default=STARTUP_TIMEOUT,
+        type=int,
+        action='store',
+        help=f'Seconds to wait for all services to become ready. (default: {STARTUP_TIMEOUT})'
+    )
+    restore_parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Overwrite an appliance already in the current directory.'
+    )
+    subparsers.add_parser(
+        'plan',
+        help='Show changes in the configuration since the last build, and what `apply` command would rebuild.'
+    )
+    subparsers.add_parser(
+        'apply',
+        help='Rebuild only apps and consumers changed in the configuration since the last build.'
     )
     args = parser.parse_args()
-    galaxy_export_volumename = args.volumename
-    if args.develop:
-        now = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
-        galaxy_export_volumename = f'{galaxy_export_volumename}_{now}' 
-
-    create_docker_compose(read_config('config.yaml'), galaxy_export_volumename, args.force_rebuild, args.develop)
-    # subprocess.run(['docker-compose', 'up'])
+    if args.command == 'process':
+        process_archive(read_config('config.yaml'), args.media_type, args.apps, args.output, args.workers, args.host)
+    elif args.command == 'up':
+        init_docker_engine()
+        if not start_appliance(args.timeout):
+            sys.exit(1)
+    elif args.command == 'bundle':
+        init_docker_engine()
+        bundle_appliance(args.bundle_file)
+    elif args.command == 'restore':
+        init_docker_engine()
+        if not restore_appliance(args.bundle_file, args.timeout, args.force):
+            sys.exit(1)
+    elif args.command == 'plan':
+        init_docker_engine()
+        print_plan(plan_changes(read_config('config.yaml'), read_state()))
+    else:
+        init_docker_engine()
+        GIT_CACHE_PATH = os.path.abspath(os.path.expanduser(args.git_cache))
+        galaxy_export_volumename = args.volumename
+        if args.develop:
+            now = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
+            galaxy_export_volumename = f'{galaxy_export_volumename}_{now}' 
+
+        config = read_config('config.yaml')
+        try:
+            if args.command == 'apply':
+                plan = plan_changes(config, read_state())
+                print_plan(plan)
+                create_docker_compose(config, galaxy_export_volumename, False, args.develop, args.jobs, args.no_cache, set(plan['targets']), plan['removed'])
+            else:
+                create_docker_compose(config, galaxy_export_volumename, args.force_rebuild, args.develop, args.jobs, args.no_cache)
+        finally:
+            if args.trace:
+                summary = tracer.write(args.trace)
+                print(f"Build took {summary['total']:.1f}s, slowest phases:")
+                for phase in summary['slowest']:
+                    print(f"  {phase['duration']:8.1f}s  {phase['category']}: {phase['name']}")
+        # subprocess.run(['docker-compose', 'up'])
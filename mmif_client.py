@@ -0,0 +1,284 @@
+#! /usr/bin/env python3
+"""
+A minimal HTTP client to send a MMIF file to a CLAMS app and save the response.
+
+This file is shipped into the CLAMS-Galaxy image next to the generated tool configurations, and
+generated tools call it instead of ``curl``. Hence it must only use the Python standard library.
+"""
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import http.client
+import json
+import os
+import shutil
+import sys
+import time
+import urllib.parse
+import zlib
+
+# read and send the request body in chunks of this size
+CHUNK_SIZE = 1 << 16
+# statuses that the app (or a proxy in front of it) can respond with when it's only temporarily unavailable
+RETRYABLE_STATUSES = {502, 503, 504}
+
+
+class AppError(Exception):
+    """
+    Raised when the app responds with an error status that is not worth retrying.
+    """
+    def __init__(self, status, reason, body):
+        super().__init__(f'{status} {reason}: {body}')
+        self.status = status
+
+
+class MMIFClient:
+    """
+    Sends MMIF files to a CLAMS app over a single keep-alive connection.
+    """
+    def __init__(self, url, timeout=None, retries=3, gzip_request=False, cache=None):
+        parsed = urllib.parse.urlsplit(url if '://' in url else f'http://{url}')
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = parsed.path or '/'
+        self.timeout = timeout
+        self.retries = retries
+        self.gzip_request = gzip_request
+        self.cache = cache
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_request_target(self, params=None):
+        if not params:
+            return self.path
+        return f'{self.path}?{urllib.parse.urlencode(params)}'
+
+    def annotate(self, input_path, output_path, params=None):
+        """
+        Streams the input MMIF file to the app, and streams the response to the output path.
+        ``params`` is a list of (name, value) pairs (or a dict) of runtime parameters.
+        The output file is only created when the app responds successfully.
+        """
+        cache_key = None
+        if self.cache is not None:
+            try:
+                cache_key = self.cache.get_key(input_path, params)
+                if self.cache.fetch(cache_key, output_path):
+                    return 200
+            except OSError as e:
+                self.disable_cache(e)
+                cache_key = None
+        status = self._annotate_with_retries(input_path, output_path, params)
+        if cache_key is not None:
+            try:
+                self.cache.store(cache_key, output_path)
+            except OSError as e:
+                # the response is already written, a cache failure must not fail the call
+                self.disable_cache(e)
+        return status
+
+    def disable_cache(self, error):
+        print(f'Result cache is not available ({error}), continuing without it', file=sys.stderr)
+        self.cache = None
+
+    def _annotate_with_retries(self, input_path, output_path, params):
+        target = self.get_request_target(params)
+        attempt = 0
+        while True:
+            try:
+                return self._annotate_once(target, input_path, output_path)
+            except (OSError, http.client.HTTPException) as e:
+                # includes socket timeouts and connections closed by the app
+                error = e
+            except AppError as e:
+                error = e
+            # the connection can be in any state after an error
+            self.close()
+            if isinstance(error, AppError) and error.status not in RETRYABLE_STATUSES:
+                raise error
+            attempt += 1
+            if attempt > self.retries:
+                raise error
+            delay = min(2 ** (attempt - 1), 30)
+            print(f'Request to {self.host}:{self.port} failed ({error}), retrying in {delay}s', file=sys.stderr)
+            time.sleep(delay)
+
+    def _annotate_once(self, target, input_path, output_path):
+        conn = self.connect()
+        headers = {'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'}
+        with open(input_path, 'rb') as input_file:
+            if self.gzip_request:
+                headers['Content-Encoding'] = 'gzip'
+                conn.request('POST', target, body=iter_gzipped(input_file), headers=headers, encode_chunked=True)
+            else:
+                headers['Content-Length'] = str(os.fstat(input_file.fileno()).st_size)
+                # sent in chunks larger than the default 8K blocks (`blocksize` is only available since Python 3.7)
+                conn.request('POST', target, body=iter(lambda: input_file.read(CHUNK_SIZE), b''), headers=headers)
+        response = conn.getresponse()
+        if response.status >= 400:
+            raise AppError(response.status, response.reason, response.read(1024).decode('utf8', 'replace'))
+        body = response
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.GzipFile(fileobj=response, mode='rb')
+        tmp_path = f'{output_path}.part'
+        try:
+            with open(tmp_path, 'wb') as output_file:
+                shutil.copyfileobj(body, output_file, CHUNK_SIZE)
+            os.replace(tmp_path, output_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if response.will_close:
+            self.close()
+        return response.status
+
+
+class ResultCache:
+    """
+    On-disk cache of app responses, keyed on the input MMIF, runtime parameters, and a namespace that 
+    identifies the app and its version. When the total size of cached responses exceeds ``max_size`` 
+    bytes, least recently used responses are evicted. Hit and miss counts are kept in ``stats.json``. 
+    Can be shared by multiple processes. 
+    """
+    def __init__(self, cache_dir, namespace, max_size):
+        self.cache_dir = cache_dir
+        self.namespace = namespace
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, input_path, params=None):
+        key = hashlib.sha256()
+        key.update(json.dumps([self.namespace, sorted(dict(params or {}).items())]).encode('utf8'))
+        with open(input_path, 'rb') as input_file:
+            for chunk in iter(lambda: input_file.read(CHUNK_SIZE), b''):
+                key.update(chunk)
+        return key.hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.mmif')
+
+    def fetch(self, key, output_path):
+        entry_path = self.get_entry_path(key)
+        try:
+            shutil.copyfile(entry_path, output_path)
+            # mtime is the recency for the eviction
+            os.utime(entry_path)
+            hit = True
+        except OSError:
+            hit = False
+        with self.locked_stats() as stats:
+            stats['hits' if hit else 'misses'] += 1
+        return hit
+
+    def store(self, key, output_path):
+        entry_path = self.get_entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        tmp_path = f'{entry_path}.{os.getpid()}.tmp'
+        shutil.copyfile(output_path, tmp_path)
+        os.replace(tmp_path, entry_path)
+        with self.locked_stats() as stats:
+            stats['size'] += os.path.getsize(entry_path)
+            if stats['size'] > self.max_size:
+                stats['size'] = self.evict(self.max_size * 9 // 10)
+
+    def evict(self, target_size):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for f_name in files:
+                if f_name.endswith('.mmif'):
+                    f_stat = os.stat(os.path.join(root, f_name))
+                    entries.append((f_stat.st_mtime, f_stat.st_size, os.path.join(root, f_name)))
+        entries.sort()
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, entry_path in entries:
+            if total_size <= target_size:
+                break
+            os.remove(entry_path)
+            total_size -= size
+        return total_size
+
+    @contextlib.contextmanager
+    def locked_stats(self):
+        stats_path = os.path.join(self.cache_dir, 'stats.json')
+        with open(f'{stats_path}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            stats = {'hits': 0, 'misses': 0, 'size': 0}
+            try:
+                with open(stats_path) as stats_file:
+                    stats.update(json.load(stats_file))
+            except (OSError, ValueError):
+                pass
+            yield stats
+            tmp_path = f'{stats_path}.tmp'
+            with open(tmp_path, 'w') as stats_file:
+                json.dump(stats, stats_file)
+            os.replace(tmp_path, stats_path)
+
+
+def iter_gzipped(f):
+    # wbits=31 writes a gzip header and trailer
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def parse_param(param):
+    name, sep, value = param.partition('=')
+    if not sep:
+        raise ValueError(f'runtime parameter must be in NAME=VALUE form: {param}')
+    return name, value
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Send a MMIF file to a CLAMS app and save the output MMIF"
+    )
+    parser.add_argument('--url', required=True, help='Address of the app, e.g., http://app-spacy-nlp:5000')
+    parser.add_argument('--input', required=True, help='Path to the input MMIF file')
+    parser.add_argument('--output', required=True, help='Path to write the output MMIF file')
+    parser.add_argument(
+        '--param',
+        action='append',
+        default=[],
+        type=parse_param,
+        help='Runtime parameter to pass to the app in NAME=VALUE form. Can be repeated.'
+    )
+    parser.add_argument('--timeout', type=float, default=None, help='Socket timeout in seconds (default: no timeout)')
+    parser.add_argument('--retries', type=int, default=3, help='Number of retries on connection errors and 502/503/504 responses (default: 3)')
+    parser.add_argument('--gzip', action='store_true', help='Compress the request body with gzip')
+    parser.add_argument('--cache-dir', default=None, help='Directory to cache responses. Caching is disabled when not given')
+    parser.add_argument('--cache-namespace', default='', help='Identifier of the app and its version, to separate cached responses of different apps')
+    parser.add_argument('--cache-size', type=int, default=10 * 1024 ** 3, help='Maximum total size of cached responses in bytes (default: 10GiB)')
+    args = parser.parse_args()
+    cache = None
+    if args.cache_dir:
+        try:
+            cache = ResultCache(args.cache_dir, args.cache_namespace, args.cache_size)
+        except OSError as e:
+            print(f'Result cache is not available ({e}), continuing without it', file=sys.stderr)
+    with MMIFClient(args.url, args.timeout, args.retries, args.gzip, cache) as client:
+        try:
+            client.annotate(args.input, args.output, args.param)
+        except (AppError, OSError, http.client.HTTPException) as e:
+            print(f'Failed to get a response from {args.url}: {e}', file=sys.stderr)
+            sys.exit(1)